@@ -50,52 +50,8 @@ if [ "$1" = 'supervisord' ]; then
     echo "In case of any problem with this image, please fill issue at https://github.com/NUKIB/misp/issues"
     echo "======================================"
 
-    misp_create_configs.py
-
-    update-crypto-policies
-
-    # Create tmp directory for cake cache
-    mkdir -p -m 770 /tmp/cake/
-    chown apache:apache /tmp/cake/
-
-    # Make config files not readable by others
-    chown root:apache /var/www/MISP/app/Config/{config.php,database.php,email.php}
-    chmod 440 /var/www/MISP/app/Config/{config.php,database.php,email.php}
-
-    # Check syntax errors in generated config files
-    su-exec apache php -n -l /var/www/MISP/app/Config/config.php
-    su-exec apache php -n -l /var/www/MISP/app/Config/database.php
-    su-exec apache php -n -l /var/www/MISP/app/Config/email.php
-
-    # Create symlinks to images from customisation
-    su-exec apache misp_image_symlinks.py
-
-    # Check if all permissions are OK
-    su-exec apache misp_check_permissions.py
-
-    # Check syntax of Apache2 configs
-    httpd -t
-
-    # Check syntax of PHP-FPM config
-    php-fpm --test
-
-    # Create database schema and check if database is ready
-    su-exec apache misp_create_database.py "$MYSQL_HOST" "$MYSQL_LOGIN" "$MYSQL_DATABASE" /var/www/MISP/INSTALL/MYSQL.sql
-
-    # Check if redis is listening and running
-    su-exec apache misp_redis_ready.py
-
-    # Update database to latest version
-    su-exec apache /var/www/MISP/app/Console/cake Admin runUpdates || true
-
-    # Checks if encryption key is valid if set, but continue even if not valid
-    if [[ -n $SECURITY_ENCRYPTION_KEY ]]; then
-      su-exec apache /var/www/MISP/app/Console/cake Admin isEncryptionKeyValid || true
-    fi
-
-    # Precompress some CSS and JavaScript files by brotli
-    brotli -f /var/www/MISP/app/webroot/css/{bootstrap,bootstrap-datepicker,bootstrap-colorpicker,font-awesome,chosen.min,main}.css
-    brotli -f /var/www/MISP/app/webroot/js/{jquery,jquery-ui.min,chosen.jquery.min,bootstrap,bootstrap-datepicker,misp,vis}.js
+    # Create configs, check them, wait for database and Redis and update database schema, independent steps runs in parallel
+    misp_startup.py
 
     # Update all data stored in JSONs like objects, warninglists etc.
     nice su-exec apache /var/www/MISP/app/Console/cake Admin updateJSON &
@@ -122,5 +78,7 @@ done
 rm -f /run/httpd/httpd.pid
 rm -f /run/syslogd.pid
 rm -f /run/vector
+# Warm-up must be executed again after restart
+rm -f /run/misp-status/warmup-done
 
 exec "$@"
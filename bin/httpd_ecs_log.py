@@ -1,12 +1,24 @@
 #!/usr/bin/env python3.12
 # This script converts Apache logs from custom-defined format to JSON
 # Generating JSON directly by setting ErrorLogFormat is problematic because of JSON escaping
+import os
 import re
 import sys
+import time
+import signal
 import socket
+import asyncio
+import bisect
 import argparse
 import logging
+import functools
 import datetime
+import queue
+import threading
+import collections
+import socketserver
+import http.server
+import multiprocessing
 import typing
 
 try:
@@ -34,76 +46,733 @@ except ModuleNotFoundError:
 ECS_VERSION = "8.11"
 DOUBLE_ESCAPE = re.compile(br'(\\x[0-9a-f]{2})')
 
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    IOV_MAX = 1024
+
+
+SPOOL_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+def ecs_template(value: dict):
+    """
+    Serialize constant part of ECS log just once, serialized JSON is then inserted when the whole log is serialized.
+    Requires orjson with Fragment support, otherwise the value is returned as it is. Returned value must not be modified.
+    """
+    if hasattr(json, "Fragment"):
+        return json.Fragment(json.dumps(value))
+    return value
+
+
+ECS = ecs_template({"version": ECS_VERSION})
+ERROR_EVENT = {
+    "category": "web",
+    "type": "error",
+    "kind": "event",
+    "provider": "misp",
+    "module": "httpd",
+    "dataset": "httpd.error",
+}
+ERROR_EVENT_TEMPLATE = ecs_template(ERROR_EVENT)
+STATS_EVENT_TEMPLATE = ecs_template({
+    "kind": "metric",
+    "provider": "misp",
+    "module": "httpd",
+    "dataset": "httpd.ecs_log.stats",
+})
+ACCESS_EVENT = {
+    "category": "web",
+    "type": "access",
+    "kind": "event",
+    "provider": "misp",
+    "module": "httpd",
+    "dataset": "httpd.access",
+}
+if hasattr(json, "Fragment"):
+    # Serialized access event without closing bracket, so duration can be appended
+    ACCESS_EVENT_PREFIX = json.dumps(ACCESS_EVENT)[:-1] + b',"duration":'
+
+
+def access_event(duration: int):
+    if hasattr(json, "Fragment") and type(duration) is int:
+        return json.Fragment(b"%s%d}" % (ACCESS_EVENT_PREFIX, duration))
+    return {**ACCESS_EVENT, "duration": duration}
+
 
 def now():
     return datetime.datetime.now(datetime.timezone.utc)
 
 
+class Histogram:
+    # Buckets in seconds, converting one line usually takes tens of microseconds
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01, 0.1, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+METRICS_HELP = {
+    "lines": ("counter", "Number of lines received from httpd"),
+    "parse_fallbacks": ("counter", "Number of access log lines that could not be parsed by fast path"),
+    "parse_failures": ("counter", "Number of lines that could not be parsed"),
+    "messages_sent": ("counter", "Number of messages sent to logger socket"),
+    "bytes_sent": ("counter", "Number of bytes sent to logger socket"),
+    "connects": ("counter", "Number of successful connections to logger socket"),
+    "connect_failures": ("counter", "Number of failed connections to logger socket"),
+    "broken_pipes": ("counter", "Number of broken connections to logger socket"),
+    "buffered": ("counter", "Number of messages stored to buffer, because logger socket was not available"),
+    "buffer_messages": ("gauge", "Number of messages in memory buffer"),
+    "spool_segments": ("gauge", "Number of spool segments waiting for sending"),
+    "spooled": ("counter", "Number of messages spooled to disk"),
+    "dropped": ("counter", "Number of messages dropped because buffer and spool was full"),
+    "errors_suppressed": ("counter", "Number of error events collapsed by error aggregator"),
+    "sampled_out": ("counter", "Number of static assets access events that was not sent because of sampling"),
+    "stage_seconds": ("histogram", "Time spent in processing stage"),
+}
+
+
+class Metrics:
+    """
+    Internal counters and per-stage latency histograms. Values are updated without lock, the GIL is enough for our
+    usage, because values are read just for monitoring.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self._gauges = {}
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def merge(self, counters: dict, histograms: typing.Dict[str, "Histogram"]):
+        """Add counters and histograms collected in another process"""
+        self.counters.update(counters)
+        for stage, histogram in histograms.items():
+            self.histograms[stage].merge(histogram)
+
+    def register(self, name: str, function: typing.Callable[[], int]):
+        """Register value that is computed when metrics are collected"""
+        self._gauges[name] = function
+
+    def snapshot(self) -> dict:
+        output = dict(self.counters)
+        for name, function in self._gauges.items():
+            output[name] = function()
+        return output
+
+    def prometheus(self, log_type: str) -> str:
+        """Returns metrics in Prometheus text exposition format"""
+        lines = []
+        values = self.snapshot()
+        for name, (typ, description) in METRICS_HELP.items():
+            metric_name = f"httpd_ecs_log_{name}_total" if typ == "counter" else f"httpd_ecs_log_{name}"
+            lines.append(f"# HELP {metric_name} {description}")
+            lines.append(f"# TYPE {metric_name} {typ}")
+
+            if typ != "histogram":
+                lines.append(f'{metric_name}{{type="{log_type}"}} {values.get(name, 0)}')
+                continue
+
+            for stage, histogram in sorted(self.histograms.items()):
+                labels = f'type="{log_type}",stage="{stage}"'
+                cumulative = 0
+                for bucket, count in zip(Histogram.BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric_name}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+                lines.append(f'{metric_name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric_name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{metric_name}_count{{{labels}}} {histogram.count}")
+
+        for cache, stats in cache_stats().items():
+            for name in ("hits", "misses"):
+                lines.append(f'httpd_ecs_log_cache_{name}_total{{type="{log_type}",cache="{cache}"}} {stats[name]}')
+
+        return "\n".join(lines) + "\n"
+
+    def stats_event(self, interval: float) -> dict:
+        """ECS event with metrics, rates are computed from difference since previous event"""
+        values = self.snapshot()
+        previous = getattr(self, "_previous", {})
+        self._previous = values
+
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            stages[stage] = {"count": histogram.count, "avg_us": round(histogram.sum / histogram.count * 1e6, 1) if histogram.count else 0}
+
+        return {
+            "@timestamp": now(),
+            "ecs": ECS,
+            "event": STATS_EVENT_TEMPLATE,
+            "httpd_ecs_log": {
+                **values,
+                "lines_per_sec": round((values.get("lines", 0) - previous.get("lines", 0)) / interval, 1),
+                "stages": stages,
+            },
+        }
+
+
+METRICS = Metrics()
+
+
+class MessageBuffer:
+    """
+    Bounded buffer for messages that could not be sent to logger socket. When buffer is full, messages are spooled to
+    segment files in spool directory. If spool directory is not set or spool is full, messages are dropped.
+    """
+
+    def __init__(self, max_bytes: int, spool_dir: typing.Optional[str] = None, spool_max_bytes: int = 0):
+        self._max_bytes = max_bytes
+        self._spool_dir = spool_dir
+        self._spool_max_bytes = spool_max_bytes
+        self._messages = collections.deque()
+        self._bytes = 0
+        self._segments = collections.deque()
+        self._segment_file = None
+        self._segment_bytes = 0
+        self._segment_counter = 0
+        self._spool_bytes = 0
+        self.spooled = 0
+        self.dropped = 0
+
+        if self._spool_dir:
+            self._init_spool()
+
+    def _init_spool(self):
+        try:
+            os.makedirs(self._spool_dir, mode=0o700, exist_ok=True)
+            # Messages spooled by previous process that was not sent yet
+            for name in sorted(os.listdir(self._spool_dir)):
+                if name.endswith(".jsonl"):
+                    path = os.path.join(self._spool_dir, name)
+                    self._segments.append(path)
+                    self._spool_bytes += os.path.getsize(path)
+        except OSError as e:
+            logging.warning(f"Could not use spool directory {self._spool_dir}, messages will not be spooled: {e}")
+            self._spool_dir = None
+            return
+
+        if self._segments:
+            logging.info(f"Found {len(self._segments)} spool segments from previous run in {self._spool_dir}")
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def spool_segments(self) -> int:
+        return len(self._segments)
+
+    def append(self, message: bytes):
+        # When something is already spooled, new message must be spooled too to keep messages order
+        if not self._segments and self._bytes + len(message) <= self._max_bytes:
+            self._messages.append(message)
+            self._bytes += len(message)
+            return
+
+        if self._spool_dir and self._spool_bytes + len(message) <= self._spool_max_bytes:
+            try:
+                self._spool(message)
+                self.spooled += 1
+                return
+            except OSError as e:
+                logging.warning(f"Could not write message to spool directory {self._spool_dir}: {e}")
+
+        if self._spool_dir:
+            self._drop()
+            return
+
+        # Without spool, buffer works as ring buffer, so the oldest messages are dropped
+        self._messages.append(message)
+        self._bytes += len(message)
+        while self._bytes > self._max_bytes and self._messages:
+            self._bytes -= len(self._messages.popleft())
+            self._drop()
+
+    def _drop(self):
+        if not self.dropped:
+            logging.warning("Message buffer is full, messages will be dropped until logger socket is available")
+        self.dropped += 1
+
+    def _spool(self, message: bytes):
+        if not self._segment_file or self._segment_bytes >= SPOOL_SEGMENT_SIZE:
+            self._close_segment()
+            self._segment_counter += 1
+            path = os.path.join(self._spool_dir, f"{time.time_ns():020d}-{self._segment_counter:06d}.jsonl")
+            self._segment_file = open(path, "ab")
+            self._segment_bytes = 0
+            self._segments.append(path)
+
+        self._segment_file.write(message)
+        self._segment_bytes += len(message)
+        self._spool_bytes += len(message)
+
+    def _close_segment(self):
+        if self._segment_file:
+            self._segment_file.close()
+            self._segment_file = None
+
+    def spill(self):
+        """
+        Write messages kept in memory to spool, so they are sent by next process. Should be called when process exits.
+        Messages in memory are older than spooled ones, so they are prepended to the oldest segment.
+        """
+        self._close_segment()
+        if not self._messages or not self._spool_dir:
+            return
+
+        messages = list(self._messages)
+        try:
+            if self._segments:
+                path = self._segments[0]
+                with open(path, "rb") as f:
+                    messages.extend(f.readlines())
+            else:
+                path = os.path.join(self._spool_dir, f"{time.time_ns():020d}-000000.jsonl")
+                self._segments.append(path)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.writelines(messages)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write {len(self._messages)} messages from buffer to spool directory {self._spool_dir}: {e}")
+            return
+
+        logging.info(f"{len(self._messages)} messages from buffer was written to spool directory {self._spool_dir}")
+        self.spooled += len(self._messages)
+        self._spool_bytes += self._bytes
+        self._messages.clear()
+        self._bytes = 0
+
+    def drain(self, send: typing.Callable[[list], None]):
+        """
+        Send buffered messages in original order by given function, that must remove sent messages from list.
+        Messages are removed from buffer only when they are sent.
+        """
+        pending = list(self._messages)
+        self._messages.clear()
+        try:
+            send(pending)
+        finally:
+            self._messages.extend(pending)
+            self._bytes = sum(len(message) for message in pending)
+
+        self._close_segment()
+        while self._segments:
+            path = self._segments[0]
+            try:
+                with open(path, "rb") as f:
+                    pending = f.readlines()
+            except FileNotFoundError:
+                self._segments.popleft()
+                continue
+
+            size = sum(len(message) for message in pending)
+            try:
+                send(pending)
+            finally:
+                if pending:
+                    # Keep just messages that was not sent
+                    with open(path, "wb") as f:
+                        f.writelines(pending)
+                    self._spool_bytes -= size - sum(len(message) for message in pending)
+
+            os.unlink(path)
+            self._segments.popleft()
+            self._spool_bytes -= size
+
+
 class EcsLogger:
     _sock = None
-    _message_buffer = []
     _exception_logged = False
 
-    def __init__(self, socket_path: str):
+    def __init__(self, socket_path: str, batch_size: int = 0, batch_age: float = 1.0, buffer: typing.Optional[MessageBuffer] = None):
+        """
+        :param socket_path: Path to Vector unix socket
+        :param batch_size: If bigger than zero, messages are collected and send in one syscall when batch reach this size in bytes
+        :param batch_age: Maximum time in seconds that message can wait in batch before it is sent
+        :param buffer: Buffer for messages that could not be sent when logger socket is not available
+        """
         self._socket_path = socket_path
+        self._message_buffer = buffer if buffer is not None else MessageBuffer(16 * 1024 * 1024)
+        self._batch_size = batch_size
+        self._batch_age = batch_age
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = 0.0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+        if self._batch_size > 0:
+            # Flush batch also when no new messages comes from httpd
+            threading.Thread(target=self._flusher, name="flusher", daemon=True).start()
 
     def _connect(self):
+        if self._sock:
+            self._sock.close()
+
         try:
             self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             self._sock.connect(self._socket_path)
-        except FileNotFoundError:
+        except OSError as e:
             if not self._exception_logged:
-                logging.warning(f"Could not connect to logger socket {self._socket_path} – file not found")
+                logging.warning(f"Could not connect to logger socket {self._socket_path} – {e.strerror or e}")
                 self._exception_logged = True
+            self._sock.close()
             self._sock = None
+            METRICS.inc("connect_failures")
             return
 
         self._exception_logged = False
-        logging.info(f"Connected to logger socket {self._socket_path}, sending {len(self._message_buffer)} messages from buffer")
+        METRICS.inc("connects")
+        buffer = self._message_buffer
+        logging.info(f"Connected to logger socket {self._socket_path}, sending {len(buffer)} messages from buffer "
+                     f"and {buffer.spool_segments} spool segments ({buffer.spooled} messages spooled, {buffer.dropped} dropped)")
 
         # Send messages in buffer that was not send before
-        for message in self._message_buffer:
-            self._sock.sendall(message)
-        self._message_buffer = []
-
-    def send(self, log: dict):
-        message = jsonl_serialize(log)
+        try:
+            buffer.drain(self._sendmsg_all)
+        except OSError as e:
+            logging.warning(f"Could not send messages from buffer to logger socket: {e}")
+            self._sock.close()
+            self._sock = None
 
+    def _sendmsg_all(self, messages: list):
+        """Send messages by as few syscalls as possible. Already sent messages are removed from given list."""
+        while messages:
+            chunk = messages[0:IOV_MAX]
+            sent = self._sock.sendmsg(chunk)
+            METRICS.inc("bytes_sent", sent)
+
+            # Find out how many messages was sent completely, sendmsg can send just part of data
+            count = 0
+            for message in chunk:
+                if sent < len(message):
+                    break
+                sent -= len(message)
+                count += 1
+
+            if sent:
+                # Message was sent partially, send rest of it
+                self._sock.sendall(memoryview(chunk[count])[sent:])
+                METRICS.inc("bytes_sent", len(chunk[count]) - sent)
+                count += 1
+
+            METRICS.inc("messages_sent", count)
+            del messages[0:count]
+
+    def _write(self, messages: list):
         if not self._sock:
             self._connect()
 
         if self._sock:
             try:
-                self._sock.sendall(message)
+                self._sendmsg_all(messages)
                 return
-            except BrokenPipeError:
-                logging.warning(f"Could not send log to logger – broken pipe, trying reconnect")
+            except OSError as e:
+                # Vector restart can cause broken pipe or connection reset
+                logging.warning(f"Could not send log to logger – {e.strerror or e}, trying reconnect")
+                METRICS.inc("broken_pipes")
                 self._connect()
-                if self._sock:
-                    self._sock.sendall(message)
+
+            if self._sock:
+                try:
+                    self._sendmsg_all(messages)
                     return
+                except OSError as e:
+                    logging.warning(f"Could not send log to logger after reconnect – {e.strerror or e}, messages will be buffered")
+                    self._sock.close()
+                    self._sock = None
+
+        # Messages that was not sent are kept in buffer and sent after reconnect
+        for message in messages:
+            self._message_buffer.append(message)
+        METRICS.inc("buffered", len(messages))
+        messages.clear()
+
+    def _flush_batch(self):
+        self._write(self._batch)
+        self._batch_bytes = 0
+
+    def _flusher(self):
+        while not self._closed.wait(self._batch_age):
+            with self._lock:
+                if self._batch and time.monotonic() - self._batch_started >= self._batch_age:
+                    self._flush_batch()
 
-        self._message_buffer.append(message)
+    def send(self, log: dict):
+        self.send_serialized([jsonl_serialize(log)])
+
+    def send_serialized(self, messages: list):
+        """Send messages that are already serialized to JSONL"""
+        with self._lock:
+            if self._batch_size <= 0:
+                # Lock is required also without batching, because stats can be sent from another thread
+                self._write(messages)
+                return
+
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.extend(messages)
+            self._batch_bytes += sum(len(message) for message in messages)
+
+            if self._batch_bytes >= self._batch_size or time.monotonic() - self._batch_started >= self._batch_age:
+                self._flush_batch()
+
+    def flush(self):
+        with self._lock:
+            if self._batch:
+                self._flush_batch()
+
+    def close(self):
+        """
+        Send all messages from batch, should be called when input is closed or process is terminated. Messages that
+        could not be sent are spooled, when spool directory is set.
+        """
+        self._closed.set()
+        with self._lock:
+            if self._batch:
+                self._flush_batch()
+            self._message_buffer.spill()
+
+    def register_metrics(self):
+        buffer = self._message_buffer
+        METRICS.register("buffer_messages", lambda: len(buffer))
+        METRICS.register("spool_segments", lambda: buffer.spool_segments)
+        METRICS.register("spooled", lambda: buffer.spooled)
+        METRICS.register("dropped", lambda: buffer.dropped)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.prometheus(self.server.log_type).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves metrics in Prometheus format over HTTP on unix socket, can be fetched by `curl --unix-socket`"""
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, log_type: str):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, MetricsHandler)
+        self.log_type = log_type
+
+
+def start_metrics_server(socket_path: str, log_type: str):
+    try:
+        server = MetricsServer(socket_path, log_type)
+    except OSError as e:
+        logging.warning(f"Could not start metrics server on {socket_path}: {e}")
+        return
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def start_stats_reporter(logger: EcsLogger, interval: float):
+    """Periodically send ECS event with metrics through the same socket as logs"""
+    def report():
+        while not logger._closed.wait(interval):
+            logger.send(METRICS.stats_event(interval))
+
+    threading.Thread(target=report, name="stats", daemon=True).start()
 
 
 def create_generic_error(message: str) -> dict:
     return {
         "@timestamp": now(),
-        "ecs": {
-            "version": ECS_VERSION,
-        },
-        "event": {
-            "category": "web",
-            "type": "error",
-            "kind": "event",
-            "provider": "misp",
-            "module": "httpd",
-            "dataset": "httpd.error",
-        },
+        "ecs": ECS,
+        "event": ERROR_EVENT_TEMPLATE,
         "message": message,
     }
 
 
+# Quoted values and numbers are removed from error message, so errors that differ just in log line are collapsed
+ERROR_MESSAGE_VARIABLE = re.compile(r"""b?'(?:[^'\\]|\\.)*'|b?"(?:[^"\\]|\\.)*"|\d+""")
+
+
+def normalize_error_message(message: str) -> str:
+    return ERROR_MESSAGE_VARIABLE.sub("?", message)
+
+
+class ErrorAggregator:
+    """
+    Collapses the same errors in time window, so many invalid lines during incident don't double socket traffic.
+    Errors are the same when they have the same kind and the same message after normalization. The first error is
+    sent immediately, following same errors in the window are just counted and sent as one event with count when the
+    window ends. Windows can be flushed from another thread.
+    """
+
+    def __init__(self, window: float = 0):
+        self.window = window
+        self.windows = {}  # (kind, normalized message) -> time when window ends
+        self._suppressed = {}  # (kind, normalized message) -> [first suppressed message, count]
+        self._lock = threading.RLock()
+
+    def report(self, kind: str, message: str, logger: EcsLogger):
+        if self.window <= 0:
+            logger.send(create_generic_error(message))
+            return
+
+        key = (kind, normalize_error_message(message))
+        with self._lock:
+            current = time.monotonic()
+            self.flush(logger, current)
+
+            if key in self.windows:
+                METRICS.inc("errors_suppressed")
+                if key in self._suppressed:
+                    self._suppressed[key][1] += 1
+                else:
+                    self._suppressed[key] = [message, 1]
+                return
+
+            self.windows[key] = current + self.window
+        logger.send(create_generic_error(message))
+
+    def flush(self, logger: EcsLogger, current: typing.Optional[float] = None, force: bool = False):
+        """Send summary for windows that already ended, or for all windows when `force` is True"""
+        with self._lock:
+            current = time.monotonic() if current is None else current
+            for key, end in list(self.windows.items()):
+                if not force and end > current:
+                    continue
+
+                del self.windows[key]
+                if key in self._suppressed:
+                    message, count = self._suppressed.pop(key)
+                    output = create_generic_error(f"{message} (similar error repeated {count} times in {self.window} seconds)")
+                    output["error"] = {"type": key[0], "count": count}  # count is custom field
+                    logger.send(output)
+
+
+def start_error_flusher(logger: EcsLogger, interval: float):
+    """Send summaries of ended error windows also when no new lines comes from httpd"""
+    def flush():
+        while not logger._closed.wait(interval):
+            ERRORS.flush(logger)
+
+    threading.Thread(target=flush, name="error-flusher", daemon=True).start()
+
+
+# Static files that are served directly by httpd
+STATIC_PATHS = ("/css/", "/js/", "/img/", "/webfonts/", "/favicon.ico")
+
+
+class StaticSampler:
+    """Sends just every Nth successful access event for static files, that are usually the most of requests"""
+
+    def __init__(self, rate: int = 1, prefixes: tuple = STATIC_PATHS):
+        self.rate = rate
+        self.prefixes = prefixes
+        self._counter = 0
+
+    def skip(self, log: dict) -> bool:
+        if self.rate <= 1:
+            return False
+
+        if log.get("status", "")[0:1] not in ("2", "3") or not log.get("request_uri", "").startswith(self.prefixes):
+            return False
+
+        self._counter += 1
+        if self._counter % self.rate == 1:
+            return False
+
+        METRICS.inc("sampled_out")
+        return True
+
+
+ERRORS = ErrorAggregator()
+SAMPLER = StaticSampler()
+
+
+def configure_access_log(error_window: float, static_sample_rate: int):
+    """Configure error aggregation and sampling"""
+    ERRORS.window = error_window
+    SAMPLER.rate = static_sample_rate
+
+
+def configure_worker(error_window: float, static_sample_rate: int):
+    """Initializer of worker processes"""
+    # Worker inherits SIGTERM handler from main process, but must be terminated by pool immediately
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    configure_access_log(error_window, static_sample_rate)
+
+
+# Values derived from access log fields are cached, because most of requests comes from small set of clients and proxies
+@functools.lru_cache(maxsize=1024)
+def split_forwarded_for(value: str) -> tuple:
+    return tuple(value.strip() for value in value.split(","))
+
+
+@functools.lru_cache(maxsize=256)
+def split_host(host: str) -> typing.Tuple[str, typing.Optional[int]]:
+    if ":" in host:
+        domain, port = host.split(":", 1)
+        return domain, int(port)
+    return host, None
+
+
+@functools.lru_cache(maxsize=1024)
+def split_user(user: str) -> typing.Tuple[str, typing.Optional[str]]:
+    if "@" in user:
+        user_id, domain = user.split("@", 1)
+        return user_id, domain
+    return user, None
+
+
+@functools.lru_cache(maxsize=16)
+def parse_http_version(server_protocol: str) -> typing.Optional[str]:
+    if server_protocol[0:5] == "HTTP/":
+        return server_protocol[5:]
+    return None
+
+
+ACCESS_LOG_CACHES = {
+    "forwarded_for": split_forwarded_for,
+    "host": split_host,
+    "user": split_user,
+    "http_version": parse_http_version,
+}
+
+
+def cache_stats() -> dict:
+    output = {}
+    for name, function in ACCESS_LOG_CACHES.items():
+        info = function.cache_info()
+        output[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+    return output
+
+
 def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
     # Normalize log by removing dash that indicates empty value from log messages
     for field in ("log_id", "request_id", "http_x_forwarded_for", "user", "http_referer", "http_location", "user_email"):
@@ -112,18 +781,19 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
 
     # Normalize integer values
     for field in ("pid", "remote_port", "server_port", "bytes_sent", "body_bytes_sent", "status"):
-        if field in log and log[field] == "-":
+        value = log[field]
+        if value.isdecimal():  # fast path for the most common case
+            log[field] = int(value)
+        elif value == "-":
             log[field] = None
         else:
             try:
-                log[field] = int(log[field])
+                log[field] = int(value)
             except ValueError:
                 log[field] = None
-                logger.send(create_generic_error(f"Could not convert access log {field} field value {log[field]} to integer"))
+                ERRORS.report(f"access_log.{field}", f"Could not convert access log {field} field value {value} to integer", logger)
 
-    http_version = None
-    if log["server_protocol"][0:5] == "HTTP/":
-        http_version = log["server_protocol"][5:]
+    http_version = parse_http_version(log["server_protocol"])
 
     client = {
         "ip": log["remote_addr"],
@@ -133,8 +803,7 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
     # If HTTP header X-Forwarded-For is present, use it as real IP and hide proxy IP in nat section
     # X-Forwarded-For can contain multiple values, see https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/X-Forwarded-For
     if log["http_x_forwarded_for"]:
-        forwarded_for = [value.strip() for value in log["http_x_forwarded_for"].split(",")]
-        forwarded_for.append(log["remote_addr"])
+        forwarded_for = (*split_forwarded_for(log["http_x_forwarded_for"]), log["remote_addr"])
 
         client = {
             "address": forwarded_for,
@@ -146,18 +815,8 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
 
     output = {
         "@timestamp": log["@timestamp"],
-        "ecs": {
-            "version": ECS_VERSION,
-        },
-        "event": {
-            "category": "web",
-            "type": "access",
-            "kind": "event",
-            "provider": "misp",
-            "module": "httpd",
-            "dataset": "httpd.access",
-            "duration": log["duration"] * 1000,  # in nanoseconds
-        },
+        "ecs": ECS,
+        "event": access_event(log["duration"] * 1000),  # in nanoseconds
         "process": {
             "pid": log["pid"],
         },
@@ -197,12 +856,10 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
         output["http"]["response"]["location"] = log["http_location"]
 
     if log["host"]:
-        if ":" in log["host"]:
-            domain, port = log["host"].split(":", 1)
-            output["url"]["domain"] = domain
-            output["url"]["port"] = int(port)
-        else:
-            output["url"]["domain"] = log["host"]
+        domain, port = split_host(log["host"])
+        output["url"]["domain"] = domain
+        if port is not None:
+            output["url"]["port"] = port
 
     if log["args"]:
         # According to ECS spec, remove ? from query string
@@ -212,12 +869,10 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
         output["user"] = {}
 
         if log["user"]:
-            if "@" in log["user"]:
-                user_id, domain = log["user"].split("@", 1)
-                output["user"]["id"] = user_id
+            user_id, domain = split_user(log["user"])
+            output["user"]["id"] = user_id
+            if domain is not None:
                 output["user"]["domain"] = domain
-            else:
-                output["user"]["id"] = log["user"]
 
         if log["user_email"]:
             output["user"]["email"] = log["user_email"]
@@ -230,21 +885,299 @@ def convert_access_log_to_ecs(log: dict, logger: EcsLogger) -> dict:
     return output
 
 
-def access_log(logger: EcsLogger):
-    for line in sys.stdin.buffer:
-        line = line.rstrip(b"\n")
+class MessageCollector:
+    """Collects serialized messages instead of sending them to socket, so they can be sent by a different way"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, log: dict):
+        self.messages.append(jsonl_serialize(log))
+
+    def pop(self) -> list:
+        messages = self.messages
+        self.messages = []
+        return messages
+
+
+class AsyncEcsWriter:
+    """
+    Sends messages from bounded queue to logger socket by non-blocking writes. When queue is full, `backpressure`
+    policy is applied:
+     * `block` - wait until there is space in queue, so reading from httpd is blocked
+     * `drop-oldest` - drop the oldest message from queue
+     * `sample` - when queue is half full, enqueue just every `sample_rate` message, then drop the oldest message
+    """
+
+    def __init__(self, socket_path: str, queue_size: int, backpressure: str = "block", sample_rate: int = 10):
+        self._socket_path = socket_path
+        self._queue = asyncio.Queue(queue_size)
+        self._backpressure = backpressure
+        self._sample_rate = sample_rate
+        self._sample_counter = 0
+        self._closing = False
+        self._stopped = False
+        self.dropped = 0
+
+    def _drop_oldest(self):
+        self._queue.get_nowait()
+        self._queue.task_done()
+        self.dropped += 1
+
+    async def put(self, message: bytes):
+        if self._stopped:
+            self.dropped += 1
+            return
+
+        if self._backpressure == "block":
+            await self._queue.put(message)
+            return
+
+        if self._backpressure == "sample" and self._queue.qsize() >= self._queue.maxsize // 2:
+            self._sample_counter += 1
+            if self._sample_counter % self._sample_rate != 0:
+                self.dropped += 1
+                return
+
+        if self._queue.full():
+            self._drop_oldest()
+        self._queue.put_nowait(message)
+
+    async def close(self, messages: typing.Iterable[bytes] = ()):
+        """
+        Enqueue remaining `messages` and wait until all messages from queue are sent. When logger socket is not
+        available, messages are dropped instead, so closing never blocks forever.
+        """
+        self._closing = True
+        for message in messages:
+            await self.put(message)
+        if not self._stopped:
+            await self._queue.put(None)
+
+    def _stop(self, messages: typing.List[bytes]):
+        """Drop all messages from queue, so producer blocked by full queue is released"""
+        self._stopped = True
+        self.dropped += len(messages)
+        for _ in messages:
+            self._queue.task_done()
+        while not self._queue.empty():
+            if self._queue.get_nowait() is not None:
+                self.dropped += 1
+            self._queue.task_done()
+
+    async def _open(self) -> typing.Optional[asyncio.StreamWriter]:
+        exception_logged = False
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self._socket_path)
+                logging.info(f"Connected to logger socket {self._socket_path}")
+                return writer
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if self._closing:
+                    logging.warning(f"Could not connect to logger socket {self._socket_path} – {e.strerror}, {self._queue.qsize()} messages will be dropped")
+                    return None
+                if not exception_logged:
+                    logging.warning(f"Could not connect to logger socket {self._socket_path} – {e.strerror}")
+                    exception_logged = True
+                await asyncio.sleep(1)
+
+    async def run(self):
+        writer = None
+        while True:
+            messages = [await self._queue.get()]
+            # Send all messages that are already in queue at once
+            while not self._queue.empty() and len(messages) < IOV_MAX:
+                messages.append(self._queue.get_nowait())
+
+            end = messages[-1] is None
+            if end:
+                messages.pop()
+
+            while messages:
+                if not writer:
+                    writer = await self._open()
+                    if not writer:
+                        self._stop(messages)
+                        return
+                try:
+                    writer.writelines(messages)
+                    await writer.drain()
+                    break
+                except (BrokenPipeError, ConnectionResetError):
+                    logging.warning(f"Could not send log to logger – broken pipe, trying reconnect")
+                    writer = None
+
+            for _ in range(len(messages) + end):
+                self._queue.task_done()
+
+            if end:
+                if writer:
+                    writer.close()
+                    await writer.wait_closed()
+                return
+
+
+def parse_access_log(line: bytes) -> typing.Optional[dict]:
+    """
+    Fast path for parsing access log in `json` format defined in misp.conf. httpd escapes non-printable chars as `\\xNN`,
+    which is not valid JSON escape sequence, so instead of running regexp for every line, backslash is escaped by simple
+    replace just when line contains such sequence. Returns None if line could not be parsed this way.
+    """
+    if b"\\x" in line:
+        line = line.replace(b"\\x", b"\\\\x")
+
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return None
+
+
+def process_access_line(line: bytes, logger: EcsLogger):
+    start = time.perf_counter()
+    METRICS.inc("lines")
+    line = line.rstrip(b"\n")
 
-        # Double escape values from httpd, as it is non valid JSON escaping
+    log = parse_access_log(line)
+    if log is None:
+        METRICS.inc("parse_fallbacks")
+        # Fallback for lines in unexpected format: double escape values from httpd, as it is non valid JSON escaping
         line = DOUBLE_ESCAPE.sub(br'\\\1', line)
 
         try:
             log = json.loads(line)
         except json.JSONDecodeError as e:
-            logger.send(create_generic_error(f"Invalid JSON access log received from httpd {e}: {line}"))
-            continue
+            METRICS.inc("parse_failures")
+            ERRORS.report("access_log.json", f"Invalid JSON access log received from httpd {e}: {line}", logger)
+            return
 
-        output = convert_access_log_to_ecs(log, logger)
-        logger.send(output)
+    if ERRORS.windows:
+        ERRORS.flush(logger)
+
+    if SAMPLER.skip(log):
+        return
+
+    parsed = time.perf_counter()
+    output = convert_access_log_to_ecs(log, logger)
+    converted = time.perf_counter()
+    logger.send(output)
+
+    METRICS.observe("parse", parsed - start)
+    METRICS.observe("convert", converted - parsed)
+    METRICS.observe("send", time.perf_counter() - converted)
+
+
+def access_log(logger: EcsLogger):
+    for line in sys.stdin.buffer:
+        process_access_line(line, logger)
+    ERRORS.flush(logger, force=True)
+
+
+def read_batches(stream: typing.BinaryIO, size: int = 64 * 1024) -> typing.Iterator[bytes]:
+    """Read complete lines that are already available in stream, so batching doesn't add any latency"""
+    remainder = b""
+    while chunk := stream.read1(size):
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end:
+            yield chunk[:end]
+    if remainder:
+        yield remainder
+
+
+def convert_access_batch(batch: bytes) -> typing.Tuple[list, dict, dict]:
+    """
+    Convert batch of access log lines to serialized messages, runs in worker process. Metrics from worker are returned
+    with messages, because worker has own copy of METRICS.
+    """
+    METRICS.reset()
+    collector = MessageCollector()
+    for line in batch.splitlines():
+        try:
+            process_access_line(line, collector)
+        except Exception as e:
+            ERRORS.report("access_log.convert", f"Could not convert access log line '{line}': {str(e)}", collector)
+    # Worker can be terminated any time, so errors are collapsed just in one batch
+    ERRORS.flush(collector, force=True)
+    # Lines are already counted by main process
+    METRICS.counters.pop("lines", None)
+    return collector.pop(), dict(METRICS.counters), dict(METRICS.histograms)
+
+
+def access_log_workers(logger: EcsLogger, workers: int):
+    """
+    Convert access logs by multiple worker processes. Main process just reads batches of lines and sends converted
+    batches to logger in the same order as they was read.
+    """
+    results = queue.Queue(workers * 4)  # limit number of batches in progress
+
+    def send_results():
+        while (item := results.get()) is not None:
+            result, started = item
+            try:
+                messages, counters, histograms = result.get()
+            except Exception as e:
+                # Batch is lost, but following batches must be still processed
+                logging.exception("Could not convert access log batch in worker process")
+                logger.send(create_generic_error(f"Could not convert access log batch in worker process: {e}"))
+                continue
+            # Lines are converted in worker processes, so just latency of whole batch is measured
+            METRICS.observe("convert_batch", time.perf_counter() - started)
+            METRICS.merge(counters, histograms)
+            logger.send_serialized(messages)
+
+    def put(item):
+        # Do not block forever when sender thread is not running
+        while sender.is_alive():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("Sender thread is not running")
+
+    with multiprocessing.Pool(workers, initializer=configure_worker, initargs=(ERRORS.window, SAMPLER.rate)) as pool:
+        sender = threading.Thread(target=send_results, name="sender")
+        sender.start()
+        try:
+            for batch in read_batches(sys.stdin.buffer):
+                METRICS.inc("lines", batch.count(b"\n"))
+                put((pool.apply_async(convert_access_batch, (batch, )), time.perf_counter()))
+        finally:
+            try:
+                put(None)
+            except RuntimeError:
+                pass
+            sender.join()
+
+
+async def access_log_async(writer: AsyncEcsWriter):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+
+    writer_task = asyncio.create_task(writer.run())
+    # Stop reading from httpd when SIGTERM is received, but send messages that are already in queue
+    reading = asyncio.current_task()
+    loop.add_signal_handler(signal.SIGTERM, reading.cancel)
+
+    collector = MessageCollector()
+    try:
+        while line := await reader.readline():
+            process_access_line(line, collector)
+            for message in collector.pop():
+                await writer.put(message)
+    except asyncio.CancelledError:
+        logging.info("SIGTERM received, sending messages from queue")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+
+    ERRORS.flush(collector, force=True)
+    await writer.close(collector.pop())
+    await writer_task
+
+    if writer.dropped:
+        logging.warning(f"{writer.dropped} messages was dropped because of backpressure or unavailable logger socket")
 
 
 def error_message_extract_code(message: str) -> typing.Optional[str]:
@@ -255,8 +1188,8 @@ def error_message_extract_code(message: str) -> typing.Optional[str]:
 
 def parse_user_from_error_log(log: dict) -> dict:
     if "error" in log and "code" in log["error"] and log["error"]["code"] == "AH01631":
-        log["event"]["category"] = "authentication"
-        log["event"]["outcome"] = "failure"
+        # Event template is shared, so it must be replaced by a new dict
+        log["event"] = {**ERROR_EVENT, "category": "authentication", "outcome": "failure"}
 
         column_pos = log["message"].find(':', 14)
         if column_pos == -1:
@@ -287,17 +1220,8 @@ def parse_error_log(line: str) -> dict:
 
         output = {
             "@timestamp": timestamp.replace(" ", "T") + "Z",
-            "ecs": {
-                "version": ECS_VERSION,
-            },
-            "event": {
-                "category": "web",
-                "type": "error",
-                "kind": "event",
-                "provider": "misp",
-                "module": "httpd",
-                "dataset": "httpd.error",
-            },
+            "ecs": ECS,
+            "event": ERROR_EVENT_TEMPLATE,
             "error": {
                 "id": log_id,
             },
@@ -331,13 +1255,24 @@ def parse_error_log(line: str) -> dict:
 
 def error_log(logger: EcsLogger):
     for line in sys.stdin:
+        start = time.perf_counter()
+        METRICS.inc("lines")
         line = line.rstrip("\n")
+        if ERRORS.windows:
+            ERRORS.flush(logger)
         try:
             output = parse_error_log(line)
         except Exception as e:
-            output = create_generic_error(f"Could not parse error log line '{line}': {str(e)}")
+            METRICS.inc("parse_failures")
+            ERRORS.report("error_log.parse", f"Could not parse error log line '{line}': {str(e)}", logger)
+            continue
+        parsed = time.perf_counter()
         logger.send(output)
 
+        METRICS.observe("parse", parsed - start)
+        METRICS.observe("send", time.perf_counter() - parsed)
+    ERRORS.flush(logger, force=True)
+
 
 def test():
     line = 'AH01631: user 8cdf6212-6511-459b-8439-f913230a9ee3@sso.example.cz/realms/staging: authorization failure for "/": '
@@ -349,6 +1284,61 @@ def test():
     jsonl = jsonl_serialize(output)
     assert jsonl[-1] == 10  # new line char in binary format
 
+    line = "2024-01-01 10:00:00.123456;proxy_fcgi;error;123;140000;10.0.0.1:5555;Zk1;AH01071: Got error 'PHP message'"
+    output = parse_error_log(line)
+    assert output["@timestamp"] == "2024-01-01T10:00:00.123456Z"
+    assert output["error"] == {"id": "Zk1", "code": "AH01071"}
+    assert output["client"] == {"ip": "10.0.0.1", "port": 5555}
+    assert output["process"]["thread"]["id"] == 140000
+
+    # Pre-serialized templates must produce the same JSON as dicts
+    output = json.loads(jsonl_serialize({"ecs": ECS, "event": access_event(1234000)}))
+    assert output == {"ecs": {"version": ECS_VERSION}, "event": {**ACCESS_EVENT, "duration": 1234000}}
+    assert json.loads(jsonl_serialize(create_generic_error("test")))["event"] == ERROR_EVENT
+
+    assert split_host("misp.example.cz:8080") == ("misp.example.cz", 8080)
+    assert split_user("8cdf6212@sso.example.cz") == ("8cdf6212", "sso.example.cz")
+    assert split_forwarded_for("192.0.2.1, 198.51.100.1") == ("192.0.2.1", "198.51.100.1")
+    assert cache_stats()["host"]["misses"] >= 1
+
+    metrics = Metrics()
+    metrics.inc("lines", 2)
+    metrics.observe("parse", 0.00003)
+    metrics.register("buffer_messages", lambda: 5)
+    text = metrics.prometheus("access_log")
+    assert 'httpd_ecs_log_lines_total{type="access_log"} 2' in text
+    assert 'httpd_ecs_log_buffer_messages{type="access_log"} 5' in text
+    assert 'httpd_ecs_log_stage_seconds_bucket{type="access_log",stage="parse",le="5e-05"} 1' in text
+    stats = json.loads(jsonl_serialize(metrics.stats_event(1.0)))
+    assert stats["event"]["dataset"] == "httpd.ecs_log.stats"
+    assert stats["httpd_ecs_log"]["lines_per_sec"] == 2
+
+    collector = MessageCollector()
+    aggregator = ErrorAggregator(60)
+    for i in range(5):
+        aggregator.report("test", f"error {i}", collector)
+    aggregator.report("other", "other error", collector)
+    aggregator.report("test", "different message", collector)
+    assert len(collector.pop()) == 3
+    aggregator.flush(collector, force=True)
+    summary = json.loads(collector.pop()[0])
+    assert summary["error"] == {"type": "test", "count": 4}
+    assert summary["message"].startswith("error 1 ")
+
+    sampler = StaticSampler(3)
+    static = {"status": "200", "request_uri": "/css/main.css"}
+    assert [sampler.skip(static) for _ in range(4)] == [False, True, True, False]
+    assert not sampler.skip({"status": "404", "request_uri": "/css/main.css"})
+    assert not sampler.skip({"status": "200", "request_uri": "/events/index"})
+
+    line = b'{"@timestamp":"2024-01-01T10:00:00.123Z","pid":"12","log_id":"-","request_id":"Zk1","http_x_forwarded_for":"192.0.2.1, 198.51.100.1","remote_addr":"10.0.0.1","remote_port":"5555","user":"8cdf6212@sso.example.cz","user_email":"user@example.cz","server_name":"misp","server_port":"80","host":"misp.example.cz:8080","request_uri":"/events/view/1\\x1b","args":"?a=\\"1\\"","bytes_sent":"100","body_bytes_sent":"50","file":"/var/www/MISP/app/webroot/index.php","request_method":"GET","status":"200","http_user_agent":"PyMISP\\t2.5","http_referer":"-","http_location":"-","server_protocol":"HTTP/1.1","duration":1234}'
+    log = parse_access_log(line)
+    assert log == json.loads(DOUBLE_ESCAPE.sub(br'\\\1', line))
+    assert log["request_uri"] == "/events/view/1\\x1b"
+    assert log["args"] == '?a="1"'
+    assert log["duration"] == 1234
+    assert parse_access_log(line[:-1]) is None
+
 
 def main():
     logging.basicConfig(format='%(asctime)s [PID %(process)d] %(message)s', level=logging.INFO)
@@ -357,20 +1347,69 @@ def main():
         prog="httpd_ecs_log",
         description="Converts httpd logs to ECS JSON and send them to socket",
     )
-    parser.add_argument("type", choices=("error_log", "access_log", "test"))
+    parser.add_argument("type", choices=("error_log", "access_log", "access_log_async", "test"))
     parser.add_argument("socket", nargs="?", default="/run/vector")
+    parser.add_argument("--batch-size", type=int, default=0, help="Send messages in batches of given size in bytes, 0 means disabled")
+    parser.add_argument("--batch-age", type=float, default=1.0, help="Maximum time in seconds that message can wait in batch")
+    parser.add_argument("--buffer-size", type=int, default=16 * 1024 * 1024, help="Maximum size in bytes of messages kept in memory when logger socket is not available")
+    parser.add_argument("--spool-dir", help="Directory where messages are spooled when buffer is full")
+    parser.add_argument("--spool-size", type=int, default=256 * 1024 * 1024, help="Maximum size in bytes of spooled messages")
+    parser.add_argument("--queue-size", type=int, default=10000, help="Maximum number of messages in queue for access_log_async")
+    parser.add_argument("--backpressure", choices=("block", "drop-oldest", "sample"), default="block", help="What to do when queue is full in access_log_async")
+    parser.add_argument("--sample-rate", type=int, default=10, help="When queue is half full, send just every Nth message (for `sample` backpressure)")
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes for converting access logs, 0 means convert in main process")
+    parser.add_argument("--metrics-socket", help="Unix socket path, where metrics in Prometheus format will be served")
+    parser.add_argument("--stats-interval", type=float, default=0, help="Send ECS event with metrics every given number of seconds, 0 means disabled")
+    parser.add_argument("--error-window", type=float, default=0, help="Collapse the same errors in given number of seconds to one event, 0 means disabled")
+    parser.add_argument("--static-sample-rate", type=int, default=1, help="Send just every Nth successful access event for static files, 1 means send all")
     parsed = parser.parse_args()
 
     if parsed.type == "test":
         test()
         return
 
-    logger = EcsLogger(parsed.socket)
+    if parsed.type == "access_log_async":
+        # Async mode sends messages directly from queue, so it doesn't support batching, spooling nor workers
+        unsupported = {"--batch-size": parsed.batch_size, "--spool-dir": parsed.spool_dir, "--workers": parsed.workers,
+                       "--metrics-socket": parsed.metrics_socket, "--stats-interval": parsed.stats_interval}
+        unsupported = [name for name, value in unsupported.items() if value]
+        if unsupported:
+            parser.error(f"argument {', '.join(unsupported)} is not supported by access_log_async")
 
-    if parsed.type == "error_log":
-        error_log(logger)
-    else:
-        access_log(logger)
+    configure_access_log(parsed.error_window, parsed.static_sample_rate)
+
+    if parsed.type == "access_log_async":
+        writer = AsyncEcsWriter(parsed.socket, parsed.queue_size, parsed.backpressure, parsed.sample_rate)
+        asyncio.run(access_log_async(writer))
+        return
+
+    # Every log type must use own spool directory
+    spool_dir = os.path.join(parsed.spool_dir, parsed.type) if parsed.spool_dir else None
+    buffer = MessageBuffer(parsed.buffer_size, spool_dir, parsed.spool_size)
+    logger = EcsLogger(parsed.socket, parsed.batch_size, parsed.batch_age, buffer)
+    logger.register_metrics()
+
+    if parsed.metrics_socket:
+        start_metrics_server(parsed.metrics_socket, parsed.type)
+    if parsed.stats_interval > 0:
+        start_stats_reporter(logger, parsed.stats_interval)
+    if parsed.error_window > 0 and parsed.workers <= 0:
+        # Worker processes collapse errors just in one batch, so there is nothing to flush
+        start_error_flusher(logger, min(parsed.error_window, 1.0))
+
+    # Convert SIGTERM to exception, so messages in batch are sent before process is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if parsed.type == "error_log":
+            error_log(logger)
+        elif parsed.workers > 0:
+            access_log_workers(logger, parsed.workers)
+        else:
+            access_log(logger)
+            logging.info(f"Access log caches statistics: {cache_stats()}")
+    finally:
+        logger.close()
 
 
 if __name__ == "__main__":
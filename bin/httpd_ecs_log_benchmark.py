@@ -0,0 +1,275 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Benchmark for httpd_ecs_log.py converters, uses synthetic logs in the same format as defined in misp.conf
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+import tracemalloc
+from typing import Callable, List
+
+ACCESS_LOG_FIELDS = (
+    "@timestamp", "pid", "log_id", "request_id", "http_x_forwarded_for", "remote_addr", "remote_port", "user",
+    "user_email", "server_name", "server_port", "host", "request_uri", "args", "bytes_sent", "body_bytes_sent", "file",
+    "request_method", "status", "http_user_agent", "http_referer", "http_location", "server_protocol")
+URIS = (
+    "/", "/users/login", "/events/index", "/events/view/1234", "/events/restSearch", "/attributes/restSearch",
+    "/servers/getVersion", "/feeds/previewIndex/1", "/css/main.css", "/js/misp.js", "/js/jquery.js",
+    "/img/orgs/1.png", "/webfonts/fa-solid-900.woff2", "/events/view/\\x22%3Cscript%3E", "/tags/index\\x00",
+)
+USER_AGENTS = (
+    "PyMISP 2.5.0 - Python 3.12.1",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0",
+    "curl/8.5.0",
+    "MISP 2.5.0 - #9f2f0d8e",
+    "Agent with \\\"quotes\\\" and \\x1b escape",
+)
+ERROR_MESSAGES = (
+    "AH01071: Got error 'PHP message: PHP Warning:  Undefined array key \"id\" in /var/www/MISP/app/Model/Event.php on line 1234'",
+    "AH01630: client denied by server configuration: /var/www/MISP/app/webroot/.env",
+    "AH01276: Cannot serve directory /var/www/MISP/app/webroot/img/: No matching DirectoryIndex found",
+    "AH10244: invalid URI path (/cgi-bin/.%2e/.%2e/bin/sh)",
+)
+
+
+def random_ip(rng: random.Random) -> str:
+    return f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def generate_access_log(count: int, seed: int = 0) -> List[bytes]:
+    """Generate access log lines in `json` LogFormat from misp.conf, values are escaped the same way as by httpd"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        forwarded_for = ", ".join(random_ip(rng) for _ in range(rng.choice((0, 0, 1, 1, 2, 3))))
+        user = rng.choice(("-", "-", "admin@admin.test", f"{rng.randbytes(16).hex()}@sso.example.cz/realms/misp"))
+        status = rng.choice(("200", "200", "200", "200", "302", "304", "403", "404", "500"))
+        values = (
+            f"2024-01-01T10:{i // 60000 % 60:02}:{i // 1000 % 60:02}.{i % 1000:03}Z",
+            str(rng.randint(100, 999)),
+            rng.choice(("-", "-", "-", "Zk1aBc")),
+            rng.randbytes(12).hex(),
+            forwarded_for if forwarded_for else "-",
+            random_ip(rng),
+            str(rng.randint(1024, 65535)),
+            user,
+            "user@example.cz" if user != "-" and rng.random() > 0.5 else "-",
+            "misp.example.cz",
+            "80",
+            rng.choice(("misp.example.cz", "misp.example.cz:8443", "")),
+            rng.choice(URIS),
+            rng.choice(("", "", "?limit=100&page=1", "?q=\\\"value\\\"")),
+            str(rng.randint(200, 2000000)),
+            str(rng.randint(0, 2000000)),
+            "/var/www/MISP/app/webroot/index.php",
+            rng.choice(("GET", "GET", "POST", "HEAD")),
+            status,
+            rng.choice(USER_AGENTS),
+            rng.choice(("-", "https://misp.example.cz/events/index")),
+            "/users/login" if status == "302" else "-",
+            rng.choice(("HTTP/1.1", "HTTP/2.0")),
+        )
+        fields = ",".join(f'"{field}":"{value}"' for field, value in zip(ACCESS_LOG_FIELDS, values))
+        lines.append(f'{{{fields},"duration":{rng.randint(100, 30000000)}}}\n'.encode())
+    return lines
+
+
+def generate_error_log(count: int, seed: int = 0) -> List[str]:
+    """Generate error log lines in ErrorLogFormat from misp.conf"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        if rng.random() < 0.05:
+            # Line that is not in expected format, for example when httpd is starting
+            lines.append("AH00558: httpd: Could not reliably determine the server's fully qualified domain name\n")
+            continue
+
+        client = f"{random_ip(rng)}:{rng.randint(1024, 65535)}" if rng.random() > 0.2 else ""
+        if rng.random() < 0.3:
+            message = f"AH01631: user {rng.randbytes(16).hex()}@sso.example.cz/realms/misp: authorization failure for \"/events/index\": "
+        else:
+            message = rng.choice(ERROR_MESSAGES)
+        lines.append(f"2024-01-01 10:{i // 60000 % 60:02}:{i // 1000 % 60:02}.{i % 1000:06};proxy_fcgi;error;"
+                     f"{rng.randint(100, 999)};{rng.randint(100000, 999999)};{client};Zk1aBc;{message}\n")
+    return lines
+
+
+def measure(lines: list, function: Callable, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            function(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    sample = lines[0:1000]
+    tracemalloc.start()
+
+    # High-water mark of traced memory while processing one line, it is not number of allocations
+    peak = 0
+    for line in sample:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        function(line)
+        peak += tracemalloc.get_traced_memory()[1] - baseline
+
+    # Memory blocks allocated while processing lines, counted by diffing snapshots. Results are kept, so blocks of
+    # returned objects are counted, but temporary objects freed before function returns are not.
+    before = tracemalloc.take_snapshot()
+    results = [function(line) for line in sample]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "traceback") if stat.count_diff > 0)
+    del results
+
+    return {
+        "lines_per_sec": round(len(lines) / best),
+        "memory_peak_bytes_per_line": round(peak / len(sample)),
+        "allocated_blocks_per_line": round(blocks / len(sample), 1),
+    }
+
+
+def run_backend(backend: str, count: int, seed: int, repeat: int) -> dict:
+    if backend == "json":
+        sys.modules["orjson"] = None  # block import, so httpd_ecs_log will use standard library
+
+    import httpd_ecs_log
+
+    if backend == "orjson" and httpd_ecs_log.json.__name__ != "orjson":
+        raise Exception("orjson backend requested, but orjson module is not installed")
+
+    access_lines = generate_access_log(count, seed)
+    error_lines = generate_error_log(count, seed)
+
+    collector = httpd_ecs_log.MessageCollector()
+    parsed = [httpd_ecs_log.parse_access_log(line.rstrip(b"\n")) for line in access_lines]
+    converted = [httpd_ecs_log.convert_access_log_to_ecs(dict(log), collector) for log in parsed]
+
+    def process_access_line(line: bytes):
+        httpd_ecs_log.process_access_line(line, collector)
+        return collector.pop()
+
+    def convert_access_log_to_ecs(log: dict):
+        return httpd_ecs_log.convert_access_log_to_ecs(dict(log), collector)
+
+    def parse_error_log(line: str):
+        return httpd_ecs_log.parse_error_log(line.rstrip("\n"))
+
+    return {
+        "process_access_line": measure(access_lines, process_access_line, repeat),
+        "convert_access_log_to_ecs": measure(parsed, convert_access_log_to_ecs, repeat),
+        "parse_error_log": measure(error_lines, parse_error_log, repeat),
+        "jsonl_serialize": measure(converted, httpd_ecs_log.jsonl_serialize, repeat),
+        "caches": httpd_ecs_log.cache_stats(),
+    }
+
+
+class CountingHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for _ in self.rfile:
+            self.server.received += 1
+
+
+class CountingServer(socketserver.ThreadingUnixStreamServer):
+    """Local replacement for Vector socket, that just counts received lines"""
+    daemon_threads = True
+    received = 0
+
+
+def run_end_to_end(count: int, seed: int, extra_args: List[str]) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, "vector.sock")
+        corpus_path = os.path.join(tmp_dir, "access.log")
+        with open(corpus_path, "wb") as f:
+            f.writelines(generate_access_log(count, seed))
+
+        server = CountingServer(socket_path, CountingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "httpd_ecs_log.py")
+        start = time.perf_counter()
+        with open(corpus_path, "rb") as corpus:
+            subprocess.run([sys.executable, script, "access_log", socket_path] + extra_args, stdin=corpus, stderr=subprocess.DEVNULL, check=True)
+
+        # Wait until all lines are received by sink
+        deadline = time.monotonic() + 10
+        while server.received < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "lines_per_sec": round(count / elapsed),
+        "received": server.received,
+    }
+
+
+def print_results(results: dict):
+    print(f"{'backend':<8} {'function':<28} {'lines/sec':>12} {'peak B/line':>12} {'blocks/line':>12}")
+    for backend, functions in results.items():
+        if backend == "end_to_end":
+            continue
+        for function, result in functions.items():
+            if function == "caches":
+                continue
+            print(f"{backend:<8} {function:<28} {result['lines_per_sec']:>12} {result['memory_peak_bytes_per_line']:>12} {result['allocated_blocks_per_line']:>12}")
+
+    for backend, functions in results.items():
+        if "caches" in functions:
+            caches = ", ".join(f"{name} {stats['hits']}/{stats['hits'] + stats['misses']}" for name, stats in functions["caches"].items())
+            print(f"\nCache hits for {backend}: {caches}")
+
+    if "end_to_end" in results:
+        result = results["end_to_end"]
+        print(f"\nEnd to end: {result['lines_per_sec']} lines/sec, {result['received']} lines received by sink")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="httpd_ecs_log_benchmark",
+        description="Benchmark httpd_ecs_log.py converters on synthetic httpd logs",
+    )
+    parser.add_argument("--lines", type=int, default=20000, help="Number of generated lines for every log type")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generating logs, the same seed generates the same logs")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats, the best result is used")
+    parser.add_argument("--backend", choices=("orjson", "json", "all"), default="all")
+    parser.add_argument("--end-to-end", action="store_true", help="Also measure throughput of httpd_ecs_log.py process sending logs to local socket")
+    parser.add_argument("--end-to-end-args", default="", help="Extra arguments for httpd_ecs_log.py in end to end test")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--run-backend", choices=("orjson", "json"), help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+
+    if parsed.run_backend:
+        # Every backend is measured in separate process, because JSON library is selected when module is imported
+        print(json.dumps(run_backend(parsed.run_backend, parsed.lines, parsed.seed, parsed.repeat)))
+        return
+
+    results = {}
+    for backend in (("orjson", "json") if parsed.backend == "all" else (parsed.backend, )):
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-backend", backend, "--lines", str(parsed.lines),
+             "--seed", str(parsed.seed), "--repeat", str(parsed.repeat)],
+            stdout=subprocess.PIPE, check=True,
+        )
+        results[backend] = json.loads(process.stdout)
+
+    if parsed.end_to_end:
+        results["end_to_end"] = run_end_to_end(parsed.lines, parsed.seed, parsed.end_to_end_args.split())
+
+    if parsed.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,16 @@ import sys
 import glob
 import uuid
 import json
+import math
+import errno
+import shutil
 import hashlib
 import argparse
+import tempfile
+import concurrent.futures
 from urllib.parse import urlparse, quote_plus
-from typing import Optional, Type, Callable, Any, NoReturn, List, Union, Tuple
-from jinja2 import Environment
+from typing import Optional, Type, Callable, Any, NoReturn, List, Union, Tuple, Iterable, Dict
+from jinja2 import Environment, BaseLoader, FileSystemBytecodeCache, TemplateNotFound, meta
 
 
 class Option:
@@ -130,6 +135,14 @@ def parse_oidc_roles(variable_name: str, value: str) -> dict:
     return dict_parser(variable_name, value, seperator=',', variable_description="OIDC roles mapping variable")
 
 
+def parse_paths(variable_name: str, value: str) -> list:
+    paths = value.split()
+    for path in paths:
+        if not path.startswith("/"):
+            raise ValueError(f"Environment variable '{variable_name}' contains invalid path '{path}', must start with '/'")
+    return paths
+
+
 def parse_x_forwarded_headers(variable_name: str, value: str) -> list:
     valid_values = ("X-Forwarded-Host", "X-Forwarded-Port", "X-Forwarded-Proto", "Forwarded")
     headers = value.split(" ")
@@ -197,6 +210,11 @@ VARIABLES = {
     "ECS_LOG_FILE": Option(typ=str),
     "ECS_LOG_FILE_FORMAT": Option(typ=str, options=("text", "ecs"), default="ecs"),
     "ECS_LOG_VECTOR_ADDRESS": Option(typ=str),
+    "ECS_LOG_HTTPD_WORKERS": Option(typ=int, default=0, validation=check_uint),
+    "ECS_LOG_HTTPD_STATS_INTERVAL": Option(typ=int, default=0, validation=check_uint),
+    "ECS_LOG_HTTPD_STATIC_SAMPLE_RATE": Option(typ=int, default=1, validation=check_uint),
+    "ECS_LOG_HTTPD_ACCESS_MODE": Option(options=("sync", "async"), default="sync"),
+    "ECS_LOG_HTTPD_BACKPRESSURE": Option(options=("block", "drop-oldest", "sample"), default="block"),
     "SYSLOG_ENABLED": Option(typ=bool, default=True),
     "SYSLOG_TARGET": Option(),
     "SYSLOG_PORT": Option(typ=int, default=601, validation=check_uint),
@@ -263,6 +281,16 @@ VARIABLES = {
     "PHP_MAX_EXECUTION_TIME": Option(typ=int, default=300, validation=check_uint),
     "PHP_UPLOAD_MAX_FILESIZE": Option(default="50M"),
     "PHP_SESSIONS_COOKIE_SAMESITE": Option(options=("Strict", "Lax"), default="Lax"),
+    "PHP_OPCACHE_MEMORY": Option(typ=int, validation=check_uint),
+    "PHP_FPM_MAX_CHILDREN": Option(typ=int, validation=check_uint),
+    "PHP_OPCACHE_PRELOAD": Option(typ=bool, default=False),
+    # Apache
+    "HTTPD_MAX_REQUEST_WORKERS": Option(typ=int, validation=check_uint),
+    # Warm-up
+    "WARMUP_ENABLED": Option(typ=bool, default=False),
+    "WARMUP_URLS": Option(default="/users/login /events/index /attributes/index", parser=parse_paths),
+    # Resources
+    "AUTOTUNE_ENABLED": Option(typ=bool, default=False),
     # Jobber
     "JOBBER_USER_ID": Option(typ=int, default=1, validation=check_uint),
     "JOBBER_CACHE_FEEDS_TIME": Option(default="0 R0-10 6,8,10,12,14,16,18"),
@@ -281,9 +309,52 @@ VARIABLES = {
     "PRIO_WORKERS": Option(typ=int, default=3, validation=check_uint),
     "UPDATE_WORKERS": Option(typ=int, default=1, validation=check_uint),
     "SCHEDULER_WORKERS": Option(typ=int, default=1, validation=check_uint),
+    "DEFAULT_WORKERS_MAX": Option(typ=int, default=0, validation=check_uint),
+    "EMAIL_WORKERS_MAX": Option(typ=int, default=0, validation=check_uint),
+    "CACHE_WORKERS_MAX": Option(typ=int, default=0, validation=check_uint),
+    "PRIO_WORKERS_MAX": Option(typ=int, default=0, validation=check_uint),
+    "UPDATE_WORKERS_MAX": Option(typ=int, default=0, validation=check_uint),
+    "WORKERS_AUTOSCALE_COOLDOWN": Option(typ=int, default=300, validation=check_uint),
+    "STATUS_DAEMON_ENABLED": Option(typ=bool, default=False),
 }
 
 CONFIG_CREATED_CANARY_FILE = "/.misp-configs-created"
+UMASK = os.umask(0)
+os.umask(UMASK)
+# Hashes of inputs of every generator from last run, so just generators with changed inputs are executed by `update`
+CONFIG_STATE_FILE = "/.misp-configs-state.json"
+# Keys in state file with hashes of rendered templates
+RENDERED_STATE_PREFIX = "rendered:"
+# Templates are rendered in place, so pristine copies are saved when image is built
+TEMPLATES_DIR = "/usr/local/share/misp-templates"
+# Compiled templates and variables used by templates, created when image is built
+TEMPLATES_CACHE_DIR = "/usr/local/share/misp-templates-cache"
+TEMPLATE_VARIABLES_FILE = f"{TEMPLATES_CACHE_DIR}/variables.json"
+MISP_CONFIGS = [f"/var/www/MISP/app/Config/{name}" for name in ("database.php", "config.php", "email.php")]
+# Variables that are loaded from files by `file_env` in docker-entrypoint.sh, must be kept in sync
+FILE_ENV_VARIABLES = (
+    "MYSQL_DATABASE", "MYSQL_LOGIN", "MYSQL_PASSWORD", "REDIS_PASSWORD", "GNUPG_PRIVATE_KEY", "GNUPG_PRIVATE_KEY_PASSWORD",
+    "SECURITY_SALT", "SECURITY_ENCRYPTION_KEY", "PROXY_USER", "PROXY_PASSWORD", "ZEROMQ_USERNAME", "ZEROMQ_PASSWORD")
+# Commands that apply changed config without restarting container
+RELOAD_COMMANDS = {
+    "httpd": "supervisorctl signal USR1 httpd",  # graceful restart
+    "php-fpm": "supervisorctl signal USR2 php-fpm",  # graceful reload
+    "misp-workers": "supervisorctl restart 'misp-workers:*'",
+    "supervisor": "supervisorctl update",
+    "vector": "supervisorctl signal HUP vector",
+    "jobber": "jobber reload",
+    "rsyslog": "supervisorctl restart rsyslog",
+}
+AUTOSCALED_QUEUES = ("DEFAULT", "EMAIL", "CACHE", "PRIO", "UPDATE")
+# Sizing model for auto-tune, see README.md
+AUTOTUNE_PHP_PROCESS_MEMORY = 128 * 1024 ** 2  # average memory of one PHP-FPM child or background worker
+AUTOTUNE_RESERVED_MEMORY = 512 * 1024 ** 2  # httpd, vector, supervisor and other processes
+HTTPD_THREADS_PER_CHILD = 25  # mpm_event default
+OPCACHE_PRELOAD_SCRIPT = "/usr/local/share/misp-preload.php"
+# Classes used by almost every request, tests and console classes are not included
+OPCACHE_PRELOAD_PATTERNS = [f"/var/www/MISP/app/Lib/cakephp/lib/Cake/{name}/**/*.php" for name in (
+    "Cache", "Controller", "Core", "Error", "Event", "I18n", "Log", "Model", "Network", "Routing", "Utility", "View")] + [
+    "/var/www/MISP/app/Controller/**/*.php", "/var/www/MISP/app/Model/**/*.php", "/var/www/MISP/app/Lib/Tools/*.php"]
 
 
 def str_filter(value: Optional[str]) -> str:
@@ -299,7 +370,47 @@ def str_or_int_filter(value: Optional[str]) -> str:
         return str_filter(value)
 
 
-jinja_env = Environment(trim_blocks=True, lstrip_blocks=True)
+# SHA-256 of files rendered by last run, file with different content was changed since then
+RENDERED_HASHES: Dict[str, str] = {}
+
+
+class TemplateLoader(BaseLoader):
+    """
+    Template name is path without leading slash. Templates are rendered in place, so file itself is used as template
+    just when it is not the output of last run, for example when user mounts own template. Otherwise pristine copy
+    saved when image was built is used.
+    """
+    def get_source(self, environment: Environment, template: str) -> Tuple[str, str, None]:
+        path = "/" + template
+        pristine_path = TEMPLATES_DIR + path
+        source_path = path
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = None
+
+        if os.path.exists(pristine_path):
+            if content is None or hashlib.sha256(content).hexdigest() == RENDERED_HASHES.get(path):
+                source_path = pristine_path
+            else:
+                with open(pristine_path, "rb") as f:
+                    if f.read() == content:
+                        source_path = pristine_path  # the same file, but compiled template is cached for pristine copy
+        elif content is None:
+            raise TemplateNotFound(template)
+
+        with open(source_path, "r") as f:
+            return f.read(), source_path, None
+
+
+jinja_env = Environment(
+    loader=TemplateLoader(),
+    bytecode_cache=FileSystemBytecodeCache(TEMPLATES_CACHE_DIR) if os.path.isdir(TEMPLATES_CACHE_DIR) else None,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    auto_reload=False,
+)
 jinja_env.filters["str"] = str_filter
 jinja_env.filters["bool"] = lambda x: 'true' if x else 'false'
 jinja_env.filters["str_or_int"] = str_or_int_filter
@@ -315,13 +426,73 @@ def warning(message: str):
 
 
 def write_file(path: str, content: str):
+    """
+    Write content to temporary file and then rename it, so readers never see partially written file. Mode and owner of
+    existing file are kept. Bind mounted file cannot be replaced, so it is overwritten in place.
+    """
     try:
-        with open(path, "w") as f:
-            f.write(content)
+        if os.path.ismount(path):
+            with open(path, "w") as f:
+                f.write(content)
+            return
+
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            current = None
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            if current:
+                os.chmod(tmp_path, current.st_mode & 0o7777)
+                if (current.st_uid, current.st_gid) != (os.getuid(), os.getgid()):
+                    os.chown(tmp_path, current.st_uid, current.st_gid)
+            else:
+                os.chmod(tmp_path, 0o666 & ~UMASK)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            os.unlink(tmp_path)
+            if e.errno != errno.EBUSY:
+                raise
+            with open(path, "w") as f:
+                f.write(content)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
     except OSError as e:
         error(f"Could not write content to {path}: {e}")
 
 
+def remove_file(path: str):
+    """Remove file created by previous run, when config is disabled"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        error(f"Could not remove {path}: {e}")
+
+
+def load_file_env():
+    """
+    Load variables from files the same way as `file_env` in docker-entrypoint.sh does, because `update` is executed
+    by `docker exec` with original container environment
+    """
+    for variable in FILE_ENV_VARIABLES:
+        file_variable = f"{variable}_FILE"
+        if os.environ.get(variable) and os.environ.get(file_variable):
+            error(f"Both '{variable}' and '{file_variable}' are set (but are exclusive)")
+        if not os.environ.get(variable) and os.environ.get(file_variable):
+            try:
+                with open(os.environ[file_variable]) as f:
+                    os.environ[variable] = f.read().rstrip("\n")
+            except OSError as e:
+                error(f"Could not read '{file_variable}': {e}")
+        os.environ.setdefault(variable, "")
+
+
 def collect() -> dict:
     variables = {}
 
@@ -334,14 +505,64 @@ def collect() -> dict:
     return variables
 
 
+def template_paths() -> List[str]:
+    return MISP_CONFIGS + error_message_paths() + ["/etc/httpd/conf.d/misp.conf", "/root/.jobber", "/etc/supervisord.d/misp.ini"]
+
+
+def template_source(path: str) -> str:
+    source, _, _ = jinja_env.loader.get_source(jinja_env, path.lstrip("/"))
+    return source
+
+
+def find_template_variables(source: str) -> List[str]:
+    return sorted(meta.find_undeclared_variables(jinja_env.parse(source)))
+
+
+def load_template_variables() -> Dict[str, dict]:
+    try:
+        with open(TEMPLATE_VARIABLES_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+TEMPLATE_VARIABLES = load_template_variables()
+
+
+def template_variables(path: str, source: str) -> List[str]:
+    """Variables used by template, from file created when image was built if template was not changed since then"""
+    cached = TEMPLATE_VARIABLES.get(path)
+    if cached and cached["sha256"] == hashlib.sha256(source.encode()).hexdigest():
+        return cached["variables"]
+    return find_template_variables(source)
+
+
+def save_templates():
+    """Save pristine copies of templates and compile them, called when image is built"""
+    os.makedirs(TEMPLATES_CACHE_DIR, exist_ok=True)
+    jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATES_CACHE_DIR)
+
+    variables = {}
+    for path in template_paths():
+        os.makedirs(os.path.dirname(TEMPLATES_DIR + path), exist_ok=True)
+        shutil.copyfile(path, TEMPLATES_DIR + path)
+
+        jinja_env.get_template(path.lstrip("/"))  # stores compiled template to bytecode cache
+        source = template_source(path)
+        variables[path] = {"sha256": hashlib.sha256(source.encode()).hexdigest(), "variables": find_template_variables(source)}
+
+    write_file(TEMPLATE_VARIABLES_FILE, json.dumps(variables, indent=2))
+
+
 def render_jinja_template(path: str, variables: dict):
-    template = jinja_env.from_string(open(path, "r").read())
+    template = jinja_env.get_template(path.lstrip("/"))
     rendered = template.render(variables)
     write_file(path, rendered)
+    RENDERED_HASHES[path] = hashlib.sha256(rendered.encode()).hexdigest()
 
 
 def validate_jinja_template(path: str):
-    jinja_env.from_string(open(path, "r").read())
+    jinja_env.get_template(path.lstrip("/"))
     print(f"Template {path} is valid", file=sys.stderr)
 
 
@@ -370,10 +591,13 @@ def generate_xdebug_config(enabled: bool, profiler_trigger: str):
                         f"xdebug.remote_enable=1\n"
 
         write_file(xdebug_config_path, xdebug_config)
+    else:
+        remove_file(xdebug_config_path)
 
 
 def generate_snuffleupagus_config(enabled: bool):
     if not enabled:
+        remove_file("/etc/php.d/40-snuffleupagus.ini")
         return
 
     config = f"; Enable 'snuffleupagus' extension module\n" \
@@ -387,6 +611,7 @@ def generate_snuffleupagus_config(enabled: bool):
 
 def generate_jit_config(enabled: bool):
     if not enabled:
+        remove_file("/etc/php.d/10-opcache-jit.ini")
         return
 
     config = f"; Enable PHP JIT\n" \
@@ -396,7 +621,9 @@ def generate_jit_config(enabled: bool):
     write_file("/etc/php.d/10-opcache-jit.ini", config)
 
 def generate_sessions_in_redis_config(enabled: bool, redis_host: str, redis_port: int, redis_use_tls: Optional[bool] = False, redis_password: Optional[str] = None):
+    config_path = "/etc/php-fpm.d/sessions.conf"
     if not enabled:
+        remove_file(config_path)
         return
 
     scheme = "tls" if redis_use_tls else "tcp"
@@ -405,7 +632,6 @@ def generate_sessions_in_redis_config(enabled: bool, redis_host: str, redis_port
         redis_password = quote_plus(redis_password)
         redis_path = f"{redis_path}&auth={redis_password}"
 
-    config_path = "/etc/php-fpm.d/sessions.conf"
     config = f"[www]\n" \
              f"php_value[session.save_handler] = redis\n" \
              f"php_value[session.save_path]    = \"{redis_path}\"\n"
@@ -415,8 +641,15 @@ def generate_sessions_in_redis_config(enabled: bool, redis_host: str, redis_port
 
 def generate_rsyslog_config(variables: dict):
     if not variables["SYSLOG_ENABLED"]:
+        remove_file("/etc/rsyslog.d/forward.conf")
+        remove_file("/etc/rsyslog.d/file.conf")
         return
 
+    if not variables["SYSLOG_TARGET"]:
+        remove_file("/etc/rsyslog.d/forward.conf")
+    if not variables["SYSLOG_FILE"]:
+        remove_file("/etc/rsyslog.d/file.conf")
+
     # Recommended setting from https://github.com/grafana/loki/blob/master/docs/clients/promtail/scraping.md#rsyslog-output-configuration
     if variables["SYSLOG_TARGET"]:
         config = f'action(\n' \
@@ -454,6 +687,7 @@ def generate_rsyslog_config(variables: dict):
 
 def generate_vector_config(variables: dict):
     if not variables["ECS_LOG_ENABLED"]:
+        remove_file("/etc/vector/sinks.json")
         return
 
     sinks = {}
@@ -520,9 +754,12 @@ def generate_vector_config(variables: dict):
     write_file("/etc/vector/sinks.json", json.dumps(output, indent=2))
 
 
-def generate_error_messages(email: str):
-    for path in glob.glob('/var/www/html/*.*html'):
-        render_jinja_template(path, {"SUPPORT_EMAIL": email})
+def error_message_paths() -> List[str]:
+    return sorted(glob.glob('/var/www/html/*.*html'))
+
+
+def generate_error_message(path: str, email: str):
+    render_jinja_template(path, {"SUPPORT_EMAIL": email})
 
 
 def generate_php_config(variables: dict):
@@ -536,24 +773,258 @@ def generate_php_config(variables: dict):
                f"session.cookie_samesite = '{variables['PHP_SESSIONS_COOKIE_SAMESITE']}'\n" \
                f"opcache.validate_timestamps = {opcache_validate_timestamps}"
 
+    if variables["PHP_OPCACHE_MEMORY"]:
+        template += f"\nopcache.memory_consumption = {variables['PHP_OPCACHE_MEMORY']}"
+
+    if variables["PHP_OPCACHE_PRELOAD"]:
+        generate_opcache_preload_script()
+        # PHP-FPM master process runs as root, so preloading must be executed as different user
+        template += f"\nopcache.preload = {OPCACHE_PRELOAD_SCRIPT}\n" \
+                    f"opcache.preload_user = apache"
+    else:
+        remove_file(OPCACHE_PRELOAD_SCRIPT)
+
     write_file("/etc/php.d/99-misp.ini", template)
 
 
+def generate_opcache_preload_script():
+    files = sorted({path for pattern in OPCACHE_PRELOAD_PATTERNS for path in glob.glob(pattern, recursive=True)})
+
+    # Files are just compiled and not executed, so order doesn't matter and classes are linked when possible
+    script = "<?php\n" \
+             "// Do not edit this file directly! It is automatically generated after every container start.\n" \
+             "foreach ([\n" + \
+             "".join(f"    {str_filter(path)},\n" for path in files) + \
+             "] as $file) {\n" \
+             "    opcache_compile_file($file);\n" \
+             "}\n"
+
+    write_file(OPCACHE_PRELOAD_SCRIPT, script)
+
+
+def generate_php_fpm_pool_config(max_children: Optional[int]):
+    # Pool sections with the same name are merged and configs are included in alphabetical order, so this file must be
+    # sorted after www.conf to override its values
+    config_path = "/etc/php-fpm.d/zz-pool-size.conf"
+    if not max_children:
+        remove_file(config_path)
+        return
+
+    min_spare_servers = max(1, min(max_children // 4, 16))
+    max_spare_servers = max(min_spare_servers, max_children // 2)
+
+    config = f"[www]\n" \
+             f"pm.max_children = {max_children}\n" \
+             f"pm.start_servers = {min_spare_servers}\n" \
+             f"pm.min_spare_servers = {min_spare_servers}\n" \
+             f"pm.max_spare_servers = {max_spare_servers}\n"
+
+    write_file(config_path, config)
+
+
 def generate_crypto_policies(crypto_policy: Optional[str]):
     if crypto_policy:
         write_file("/etc/crypto-policies/config", crypto_policy)
 
 
+class Generator:
+    def __init__(self, name: str, function: Callable[[dict], None], variables: Iterable[str] = (),
+                 templates: Iterable[str] = (), services: Tuple[str, ...] = ()):
+        """
+        :param name: Unique generator name, used as key in state file
+        :param function: Function that generates configs from variables
+        :param variables: Names of variables the function depends on, variables used in templates are added automatically
+        :param templates: Templates rendered by the function
+        :param services: Services that must be reloaded when configs generated by this generator changes
+        """
+        self.name = name
+        self.function = function
+        self.variables = set(variables)
+        self.templates = list(templates)
+        self.services = services
+
+    def digest(self, variables: dict) -> str:
+        """Hash of template sources and values of all variables that generator depends on"""
+        digest = hashlib.sha256()
+        names = set(self.variables)
+        for path in self.templates:
+            source = template_source(path)
+            digest.update(source.encode())
+            names.update(template_variables(path, source))
+
+        values = {name: variables.get(name) for name in names}
+        digest.update(json.dumps(values, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+
+    def outputs_modified(self) -> bool:
+        """True when rendered template was changed after last run, for example replaced by user"""
+        for path in self.templates:
+            try:
+                with open(path, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != RENDERED_HASHES.get(path):
+                        return True
+            except FileNotFoundError:
+                return True
+        return False
+
+
+def variables_with_prefix(prefix: str) -> List[str]:
+    return [name for name in VARIABLES if name.startswith(prefix)]
+
+
+def generators() -> List[Generator]:
+    # Every error page is rendered by separate generator, so they can be rendered concurrently
+    error_messages = [Generator(f"error_message:{os.path.basename(path)}", lambda v, path=path: generate_error_message(path, v["SUPPORT_EMAIL"]), templates=[path])
+                      for path in error_message_paths()]
+
+    return error_messages + [
+        Generator("misp_configs", lambda v: [render_jinja_template(path, v) for path in MISP_CONFIGS],
+                  templates=MISP_CONFIGS, services=("php-fpm", "misp-workers")),
+        Generator("xdebug", lambda v: generate_xdebug_config(v["PHP_XDEBUG_ENABLED"], v["PHP_XDEBUG_PROFILER_TRIGGER"]),
+                  variables=("PHP_XDEBUG_ENABLED", "PHP_XDEBUG_PROFILER_TRIGGER"), services=("php-fpm",)),
+        Generator("snuffleupagus", lambda v: generate_snuffleupagus_config(v["PHP_SNUFFLEUPAGUS"]),
+                  variables=("PHP_SNUFFLEUPAGUS",), services=("php-fpm",)),
+        # PHP JIT is not supported when snuffleupagus is enabled
+        Generator("jit", lambda v: generate_jit_config(not v["PHP_SNUFFLEUPAGUS"]),
+                  variables=("PHP_SNUFFLEUPAGUS",), services=("php-fpm",)),
+        Generator("sessions_in_redis", lambda v: generate_sessions_in_redis_config(v["PHP_SESSIONS_IN_REDIS"], v["REDIS_HOST"], v["REDIS_PORT"], v["REDIS_USE_TLS"], v["REDIS_PASSWORD"]),
+                  variables=("PHP_SESSIONS_IN_REDIS", "REDIS_HOST", "REDIS_PORT", "REDIS_USE_TLS", "REDIS_PASSWORD"), services=("php-fpm",)),
+        Generator("apache", generate_apache_config, templates=["/etc/httpd/conf.d/misp.conf"], services=("httpd",)),
+        Generator("rsyslog", generate_rsyslog_config, variables=variables_with_prefix("SYSLOG_"), services=("rsyslog",)),
+        Generator("vector", generate_vector_config, variables=variables_with_prefix("ECS_LOG_"), services=("vector",)),
+        Generator("php_fpm_pool", lambda v: generate_php_fpm_pool_config(v["PHP_FPM_MAX_CHILDREN"]),
+                  variables=("PHP_FPM_MAX_CHILDREN",), services=("php-fpm",)),
+        Generator("php_config", generate_php_config, variables=["MISP_DEBUG"] + variables_with_prefix("PHP_"), services=("php-fpm",)),
+        # Crypto policy is applied before any process is started, so container must be restarted
+        Generator("crypto_policies", lambda v: generate_crypto_policies(v["SECURITY_CRYPTO_POLICY"]),
+                  variables=("SECURITY_CRYPTO_POLICY",), services=("container",)),
+        Generator("jobber", generate_jobber_config, templates=["/root/.jobber"], services=("jobber",)),
+        Generator("supervisor", generate_supervisor_config, templates=["/etc/supervisord.d/misp.ini"], services=("supervisor",)),
+    ]
+
+
+def load_state() -> Dict[str, str]:
+    try:
+        with open(CONFIG_STATE_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        warning(f"Could not load config state from {CONFIG_STATE_FILE}, all configs will be generated: {e}")
+        return {}
+
+
+def save_state(state: Dict[str, str]):
+    try:
+        with os.fdopen(os.open(CONFIG_STATE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(state, f, indent=2)
+    except OSError as e:
+        error(f"Could not save config state to {CONFIG_STATE_FILE}: {e}")
+
+
+def load_rendered_hashes(state: Dict[str, str]):
+    RENDERED_HASHES.update({key[len(RENDERED_STATE_PREFIX):]: value for key, value in state.items() if key.startswith(RENDERED_STATE_PREFIX)})
+
+
+def rendered_state() -> Dict[str, str]:
+    return {RENDERED_STATE_PREFIX + path: value for path, value in RENDERED_HASHES.items()}
+
+
+def run_generators(selected: List[Generator], variables: dict) -> Dict[str, str]:
+    """Run generators concurrently, every generator writes different files. Returns digest of every generator."""
+    def run(generator: Generator) -> str:
+        generator.function(variables)
+        return generator.digest(variables)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {generator.name: executor.submit(run, generator) for generator in selected}
+        return {name: future.result() for name, future in futures.items()}
+
+
 def validate():
-    for template_name in ("database.php", "config.php", "email.php"):
-        path = f"/var/www/MISP/app/Config/{template_name}"
-        validate_jinja_template(path)
-    for path in glob.glob('/var/www/html/*.*html'):
+    for path in MISP_CONFIGS + error_message_paths():
         validate_jinja_template(path)
     validate_jinja_template("/etc/httpd/conf.d/misp.conf")
     validate_jinja_template("/etc/supervisord.d/misp.ini")
 
 
+def clamp(value: int, minimum: int, maximum: int) -> int:
+    return max(minimum, min(maximum, value))
+
+
+def read_cgroup_file(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def detect_cpus() -> int:
+    """Number of CPUs available to container, CPU quota from cgroup v2 or v1 is applied if set"""
+    cpus = len(os.sched_getaffinity(0))
+
+    quota, period = None, None
+    cpu_max = read_cgroup_file("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, period = cpu_max.split()
+    else:
+        quota = read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+
+    if quota and period and quota not in ("max", "-1"):
+        # Partial CPU is rounded up, at least one CPU is available
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+
+    return cpus
+
+
+def detect_memory() -> int:
+    """Memory in bytes available to container, memory limit from cgroup v2 or v1 is applied if set"""
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    limit = read_cgroup_file("/sys/fs/cgroup/memory.max") or read_cgroup_file("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if limit and limit != "max":
+        # cgroup v1 reports huge number when memory is not limited
+        memory = min(memory, int(limit))
+
+    return memory
+
+
+def autotune(variables: dict, cpus: int, memory: int):
+    """
+    Compute pool sizes, opcache memory and number of workers from available CPUs and memory. Variables explicitly set
+    by environment variables are kept.
+    """
+    gib = 1024 ** 3
+    tuned = {
+        "DEFAULT_WORKERS": clamp(cpus // 2, 1, 4),
+        "EMAIL_WORKERS": clamp(cpus // 2, 1, 3),
+        "CACHE_WORKERS": clamp(cpus // 4, 1, 2),
+        "PRIO_WORKERS": clamp(cpus, 2, 8),
+        "PHP_OPCACHE_MEMORY": 256 if memory >= 4 * gib else 128,
+        "PHP_MEMORY_LIMIT": f"{clamp(memory // 4 // 1024 ** 2 // 128 * 128, 256, 2048)}M",
+    }
+    tuned = {name: value for name, value in tuned.items() if name not in os.environ}
+    variables.update(tuned)
+
+    workers = sum(variables[f"{queue}_WORKERS"] for queue in AUTOSCALED_QUEUES) + variables["SCHEDULER_WORKERS"]
+    free_memory = memory - AUTOTUNE_RESERVED_MEMORY - variables["PHP_OPCACHE_MEMORY"] * 1024 ** 2 - workers * AUTOTUNE_PHP_PROCESS_MEMORY
+    max_children = clamp(free_memory // AUTOTUNE_PHP_PROCESS_MEMORY, 4, cpus * 8)
+    # httpd threads are cheap and most of them just wait for PHP-FPM or serve static files
+    max_request_workers = clamp(math.ceil(max_children * 4 / HTTPD_THREADS_PER_CHILD) * HTTPD_THREADS_PER_CHILD, 100, 1000)
+
+    for name, value in (("PHP_FPM_MAX_CHILDREN", max_children), ("HTTPD_MAX_REQUEST_WORKERS", max_request_workers)):
+        if name not in os.environ:
+            variables[name] = value
+            tuned[name] = value
+
+    print(f"Auto-tune: detected {cpus} CPUs and {memory // 1024 ** 2} MiB of memory", file=sys.stderr)
+    for name, value in tuned.items():
+        print(f"Auto-tune: {name} = {value}", file=sys.stderr)
+
+
 def check_warnings(variables: dict):
     if variables["MISP_DEBUG"]:
         warning("Debug mode is enabled. Please do not forget to disable for production usage - debug mode is insecure and slow.")
@@ -573,12 +1044,23 @@ def check_warnings(variables: dict):
     elif len(variables["SECURITY_ENCRYPTION_KEY"]) < 32:
         warning("'SECURITY_ENCRYPTION_KEY' environment variable should be at least 32 chars long")
 
+    if variables["ECS_LOG_HTTPD_ACCESS_MODE"] == "async":
+        for name in ("ECS_LOG_HTTPD_WORKERS", "ECS_LOG_HTTPD_STATS_INTERVAL"):
+            if variables[name]:
+                warning(f"'{name}' is ignored when 'ECS_LOG_HTTPD_ACCESS_MODE' is `async`")
+
+    for queue in AUTOSCALED_QUEUES:
+        if 0 < variables[f"{queue}_WORKERS_MAX"] < variables[f"{queue}_WORKERS"]:
+            warning(f"'{queue}_WORKERS_MAX' is lower than '{queue}_WORKERS', autoscaling of {queue.lower()} workers is disabled")
+
     if variables["SYSLOG_ENABLED"]:
         warning("Syslog is deprecated and will be removed in near future. Please switch to ECS log instead.")
 
 
-def create():
+def prepare_variables() -> dict:
     variables = collect()
+    if variables["AUTOTUNE_ENABLED"]:
+        autotune(variables, detect_cpus(), detect_memory())
     check_warnings(variables)
 
     variables["SERVER_NAME"] = urlparse(variables["MISP_BASEURL"]).netloc
@@ -606,25 +1088,54 @@ def create():
         if "/.well-known/openid-configuration" not in variables["OIDC_PROVIDER"]:
             variables["OIDC_PROVIDER"] = f"{variables['OIDC_PROVIDER'].rstrip('/')}/.well-known/openid-configuration"
 
+    # Queues in format `name:min:max` for misp_workers_autoscale.py, autoscaling is enabled when max is bigger than min
+    variables["WORKERS_AUTOSCALE"] = []
+    for queue in AUTOSCALED_QUEUES:
+        minimum, maximum = variables[f"{queue}_WORKERS"], variables[f"{queue}_WORKERS_MAX"]
+        if maximum > minimum:
+            variables["WORKERS_AUTOSCALE"].append(f"{queue.lower()}:{minimum}:{maximum}")
+
+    return variables
+
+
+def create():
+    variables = prepare_variables()
+
     # Start modifying files
     open(CONFIG_CREATED_CANARY_FILE, 'a').close()  # touch
 
-    for template_name in ("database.php", "config.php", "email.php"):
-        path = f"/var/www/MISP/app/Config/{template_name}"
-        render_jinja_template(path, variables)
+    state = run_generators(generators(), variables)
+    save_state({**state, **rendered_state()})
+
 
-    generate_xdebug_config(variables["PHP_XDEBUG_ENABLED"], variables["PHP_XDEBUG_PROFILER_TRIGGER"])
-    generate_snuffleupagus_config(variables['PHP_SNUFFLEUPAGUS'])
-    generate_jit_config(not variables['PHP_SNUFFLEUPAGUS']) # PHP JIT is not supported when snuffleupagus is enabled
-    generate_sessions_in_redis_config(variables["PHP_SESSIONS_IN_REDIS"], variables["REDIS_HOST"], variables["REDIS_PORT"], variables["REDIS_USE_TLS"], variables["REDIS_PASSWORD"])
-    generate_apache_config(variables)
-    generate_rsyslog_config(variables)
-    generate_vector_config(variables)
-    generate_error_messages(variables["SUPPORT_EMAIL"])
-    generate_php_config(variables)
-    generate_crypto_policies(variables["SECURITY_CRYPTO_POLICY"])
-    generate_jobber_config(variables)
-    generate_supervisor_config(variables)
+def update():
+    """Generate just configs which inputs changed since last run and print how to reload affected services"""
+    load_file_env()
+    variables = prepare_variables()
+    state = load_state()
+    load_rendered_hashes(state)
+
+    changed = [generator for generator in generators() if state.get(generator.name) != generator.digest(variables) or generator.outputs_modified()]
+    services = []
+    for generator in changed:
+        print(f"Generating {generator.name} configs")
+        services.extend(service for service in generator.services if service not in services)
+
+    state.update(run_generators(changed, variables))
+    state.update(rendered_state())
+    save_state(state)
+
+    if not services:
+        print("No service must be reloaded")
+        return
+
+    if "container" in services:
+        print("Crypto policy changed, container must be restarted")
+        services.remove("container")
+    if services:
+        print("To apply changed configs, run:")
+        for service in services:
+            print(f"  {RELOAD_COMMANDS[service]}")
 
 
 def main():
@@ -632,7 +1143,7 @@ def main():
         prog="misp_create_configs",
         description="Create configs from env variables",
     )
-    arg_parser.add_argument("action", nargs="?", choices=("create", "validate", "sensitive-variables"))
+    arg_parser.add_argument("action", nargs="?", choices=("create", "update", "validate", "sensitive-variables", "save-templates"))
     parsed = arg_parser.parse_args()
 
     if parsed.action == "sensitive-variables":
@@ -641,9 +1152,15 @@ def main():
                 print(variable_name)
         sys.exit(0)
 
+    if parsed.action == "save-templates":
+        save_templates()
+        sys.exit(0)
+
     configs_created = os.path.exists(CONFIG_CREATED_CANARY_FILE)
 
-    if parsed.action == "validate":
+    if parsed.action == "update" and configs_created:
+        update()
+    elif parsed.action == "validate":
         if configs_created:
             error(f"Configs was already created (canary file {CONFIG_CREATED_CANARY_FILE} exists), it is not possible to validate them")
 
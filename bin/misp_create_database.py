@@ -1,14 +1,38 @@
 #!/usr/bin/env python3.12
 # Copyright (C) 2022 National Cyber and Information Security Agency of the Czech Republic
 import os
+import re
 import sys
+import json
 import time
+import hashlib
 import logging
 import argparse
+import misp_readiness
 import pymysql.cursors
 from pymysql.constants import CLIENT
 from pymysql.connections import Connection
-from typing import Optional, TextIO
+from typing import Optional, Iterable, Iterator
+
+# In normal state, just these chars can change state of SQL splitter
+SPECIAL_CHARS = re.compile(r"['\"`;#/-]")
+# In quoted state, just closing quote or escape char can change state
+QUOTE_CHARS = {
+    "'": re.compile(r"['\\]"),
+    '"': re.compile(r'["\\]'),
+    "`": re.compile(r"`"),
+}
+# Leading comments are skipped, but keyword is also searched in MySQL executable comments like `/*!40101 SET ... */`
+STATEMENT_KEYWORD = re.compile(r"^(?:\s*/\*[^!].*?\*/)*\s*(?:/\*!\d*\s*)?(\w+)", re.S)
+STATEMENT_TABLE = re.compile(
+    r"^(?:\s*/\*[^!].*?\*/)*\s*(?:/\*!\d*\s*)?(?:CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|"
+    r"(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO|UPDATE|DELETE\s+FROM|CREATE\s+(?:UNIQUE\s+)?INDEX\s+\S+\s+ON)\s+`?([\w$]+)`?",
+    re.S | re.I,
+)
+# Statements that are executed in transactions, other statements (DDL) causes implicit commit in MySQL
+DML_KEYWORDS = ("INSERT", "REPLACE", "UPDATE", "DELETE")
+# Statements that change session state, they must be executed again when import is resumed
+SESSION_KEYWORDS = ("SET", "USE")
 
 
 def connect(host: str, port: int, user: str, password: Optional[str]) -> pymysql.connections.Connection:
@@ -19,18 +43,12 @@ def connect(host: str, port: int, user: str, password: Optional[str]) -> pymysql
 
 def wait_for_connection(host: str, port: int, user: str, password: Optional[str]) -> Connection:
     logging.info(f"Connecting to MySQL server {host}:{port}")
-    last_exception = None
-    for i in range(1, 10):
-        try:
-            return connect(host, port, user, password)
-        except Exception as e:
-            last_exception = e            
-            logging.info("Waiting for database connection...")            
-            logging.info(e)
-            time.sleep(1)
-    logging.error(f"Could not connect to database server {host}:{port}")
-    print(last_exception, file=sys.stderr)
-    sys.exit(1)
+    try:
+        return misp_readiness.wait_for(f"MySQL server {host}:{port}", lambda: connect(host, port, user, password))
+    except TimeoutError as e:
+        logging.error(f"Could not connect to database server {host}:{port}")
+        print(e.__cause__ or e, file=sys.stderr)
+        sys.exit(1)
 
 
 def is_schema_created(connection: Connection, database: str) -> bool:
@@ -39,11 +57,253 @@ def is_schema_created(connection: Connection, database: str) -> bool:
         return bool(cursor.fetchone()[0])
 
 
-def create_schema(connection: Connection, schema_file: TextIO):
-    schema = schema_file.read()
+def has_tables(connection: Connection, database: str) -> bool:
     with connection.cursor() as cursor:
-        cursor.execute(schema)
-    connection.commit()
+        cursor.execute("select count(*) from information_schema.tables where table_schema=%s", database)
+        return bool(cursor.fetchone()[0])
+
+
+def split_statements(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Split SQL file to statements without reading whole file to memory. Semicolons in strings, quoted identifiers and
+    comments are ignored. Line comments are removed, block comments are kept, because they can contain MySQL
+    executable comments like `/*!40101 SET NAMES utf8 */`.
+    """
+    statement = []
+    quote = None
+    block_comment = False
+
+    for line in lines:
+        if not quote and not block_comment and not statement and line.lstrip()[0:10].upper() == "DELIMITER ":
+            raise ValueError("DELIMITER command is not supported in schema file")
+
+        start = i = 0
+        length = len(line)
+        while i < length:
+            if block_comment:
+                end = line.find("*/", i)
+                if end == -1:
+                    break
+                block_comment = False
+                i = end + 2
+            elif quote:
+                match = QUOTE_CHARS[quote].search(line, i)
+                if match is None:
+                    break
+                i = match.start()
+                if line[i] == "\\":
+                    i += 2
+                elif line.startswith(quote, i + 1):  # quote escaped by doubling
+                    i += 2
+                else:
+                    quote = None
+                    i += 1
+            else:
+                match = SPECIAL_CHARS.search(line, i)
+                if match is None:
+                    break
+                i = match.start()
+                char = line[i]
+                if char in "'\"`":
+                    quote = char
+                    i += 1
+                elif char == ";":
+                    statement.append(line[start:i])
+                    output = "".join(statement).strip()
+                    if output:
+                        yield output
+                    statement = []
+                    start = i = i + 1
+                elif char == "#" or (char == "-" and line.startswith("--", i) and line[i + 2:i + 3] in (" ", "\t", "\n", "\r", "")):
+                    # Line comment, skip rest of line except new line char
+                    statement.append(line[start:i])
+                    newline = line.find("\n", i)
+                    start = i = length if newline == -1 else newline
+                elif char == "/" and line.startswith("/*", i):
+                    block_comment = True
+                    i += 2
+                else:
+                    i += 1
+
+        if start < length:
+            statement.append(line[start:])
+
+    if quote or block_comment:
+        raise ValueError("Schema file ends in the middle of string or comment")
+
+    output = "".join(statement).strip()
+    if output:
+        yield output
+
+
+def statement_keyword(statement: str) -> str:
+    match = STATEMENT_KEYWORD.match(statement)
+    return match.group(1).upper() if match else ""
+
+
+def statement_table(statement: str) -> Optional[str]:
+    match = STATEMENT_TABLE.match(statement)
+    return match.group(1) if match else None
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class ImportState:
+    """
+    Number of already executed statements, so import can be resumed after failure. State is valid just for the same
+    schema file and the same database.
+    """
+
+    def __init__(self, path: Optional[str], schema_hash: str, target: str):
+        self.path = path
+        self.schema_hash = schema_hash
+        self.target = target
+        self.executed = 0
+
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read schema import state file {self.path}, ignoring: {e}")
+            return
+
+        if state.get("schema_hash") != schema_hash:
+            logging.warning(f"Schema import state file {self.path} is for different schema file, ignoring")
+        elif state.get("target") != target:
+            logging.warning(f"Schema import state file {self.path} is for different database, ignoring")
+        else:
+            self.executed = state.get("executed", 0)
+
+    def save(self, executed: int):
+        self.executed = executed
+        if not self.path:
+            return
+
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"schema_hash": self.schema_hash, "target": self.target, "executed": executed}, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.warning(f"Could not write schema import state file {self.path}, import could not be resumed: {e}")
+            self.path = None
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def reset(self):
+        self.executed = 0
+        self.remove()
+
+
+class TableProgress:
+    def __init__(self, total_bytes: int):
+        self.total_bytes = total_bytes
+        self.read_bytes = 0
+        self.table = None
+        self.table_statements = 0
+        self.table_time = 0.0
+        self.tables = 0
+
+    def add(self, table: Optional[str], statements: int, elapsed: float):
+        if table != self.table:
+            self._report()
+            self.table = table
+            self.table_statements = 0
+            self.table_time = 0.0
+        self.table_statements += statements
+        self.table_time += elapsed
+
+    def _report(self):
+        if self.table is None:
+            return
+        self.tables += 1
+        percent = self.read_bytes * 100 // self.total_bytes if self.total_bytes else 100
+        logging.info(f"Table `{self.table}`: {self.table_statements} statements in {self.table_time:.3f} s ({percent} % of schema file)")
+
+    def finish(self):
+        self._report()
+        self.table = None
+
+
+def execute(connection: Connection, statements: list):
+    """Execute multiple statements in one round trip"""
+    with connection.cursor() as cursor:
+        cursor.execute(";\n".join(statements))
+        while cursor.nextset():
+            pass
+
+
+def create_schema(connection: Connection, schema_path: str, state: ImportState, batch_size: int = 100):
+    """
+    Execute statements from schema file one by one. Consecutive DML statements for the same table are executed in
+    batches in one transaction. After every executed statement or batch, state is saved, so when import fails, it can be
+    resumed from the last successful statement.
+    """
+    progress = TableProgress(os.path.getsize(schema_path))
+    executed = 0
+    batch = []
+    batch_table = None
+
+    if state.executed:
+        logging.info(f"Resuming schema import, skipping {state.executed} already executed statements")
+
+    def flush_batch():
+        nonlocal executed, batch
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            connection.begin()
+            execute(connection, batch)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        executed += len(batch)
+        state.save(executed)
+        progress.add(batch_table, len(batch), time.perf_counter() - start)
+        batch = []
+
+    with open(schema_path, encoding="utf-8") as schema_file:
+        for statement in split_statements(schema_file):
+            progress.read_bytes = schema_file.buffer.tell()
+            keyword = statement_keyword(statement)
+
+            if keyword in SESSION_KEYWORDS:
+                flush_batch()
+                execute(connection, [statement])
+                continue
+
+            if executed < state.executed:
+                executed += 1
+                continue
+
+            table = statement_table(statement)
+            if keyword in DML_KEYWORDS:
+                if batch and (table != batch_table or len(batch) >= batch_size):
+                    flush_batch()
+                batch.append(statement)
+                batch_table = table
+                continue
+
+            flush_batch()
+            start = time.perf_counter()
+            execute(connection, [statement])
+            executed += 1
+            state.save(executed)
+            progress.add(table, 1, time.perf_counter() - start)
+
+        flush_batch()
+
+    progress.finish()
+    logging.info(f"Executed {executed} statements for {progress.tables} tables")
 
 
 def main():
@@ -53,7 +313,9 @@ def main():
     parser.add_argument("host")
     parser.add_argument("user")
     parser.add_argument("database")
-    parser.add_argument("schema_file", type=argparse.FileType("r"))
+    parser.add_argument("schema_file")
+    parser.add_argument("--state-file", default="/var/www/MISP/app/tmp/logs/schema-import.json", help="File for storing schema import progress, so import can be resumed after failure")
+    parser.add_argument("--batch-size", type=int, default=100, help="Maximum number of DML statements executed in one transaction")
     args = parser.parse_args()
 
     password = os.environ.get("MYSQL_PASSWORD")
@@ -62,7 +324,14 @@ def main():
 
     connection = wait_for_connection(args.host, port, args.user, password)
 
-    if is_schema_created(connection, args.database):
+    state = ImportState(args.state_file, file_hash(args.schema_file), f"{args.host}:{port}/{args.database}")
+    # When previous import failed, schema can be partially created, so it must be finished. But if database was dropped
+    # in meantime, import must start from the beginning.
+    if state.executed and not has_tables(connection, args.database):
+        logging.warning(f"Schema import state says {state.executed} statements were executed, but database {args.database} is empty, starting from the beginning")
+        state.reset()
+
+    if not state.executed and is_schema_created(connection, args.database):
         logging.info("Database schema is already created.")
         connection.close()
         sys.exit(0)
@@ -76,8 +345,15 @@ def main():
         sys.exit(1)
 
     logging.info("Creating database schema...")
-    create_schema(connection, args.schema_file)
-    logging.info("Database schema created.")
+    start = time.perf_counter()
+    try:
+        create_schema(connection, args.schema_file, state, args.batch_size)
+    except Exception as e:
+        logging.error(f"Could not create database schema, import will be resumed on next start: {e}")
+        connection.close()
+        sys.exit(1)
+    state.remove()
+    logging.info(f"Database schema created in {time.perf_counter() - start:.2f} s.")
 
     connection.close()
     sys.exit(0)
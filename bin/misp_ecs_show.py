@@ -1,17 +1,60 @@
 #!/usr/bin/env python3.12
 # Copyright (C) 2023 National Cyber and Information Security Agency of the Czech Republic
+import os
+import re
 import sys
+import glob
+import gzip
+import bisect
 import orjson
 import argparse
+import datetime
 import subprocess
-from typing import Optional
-from pprint import pformat
+from typing import Optional, Iterator, List, Tuple, Dict
 
 POSSIBLE_DATASETS = (
-    "httpd.access", "httpd.error", "php-fpm.access", "php-fpm.error", "jobber.runs", "supervisor.log", "system.logs",
-    "application.logs")
+    "httpd.access", "httpd.error", "httpd.ecs_log.stats", "php-fpm.access", "php-fpm.error", "php-fpm.www-error",
+    "jobber.runs", "supervisor.log", "system.logs", "application.logs")
 POSSIBLE_MODULES = ("httpd", "php-fpm", "jobber", "supervisor", "system", "application")
 
+# Vector components that produce given dataset or module (see vector.yaml), so `vector tap` sends just events that
+# can match filter instead of all events. Events from socket are not split by dataset in vector, because that would
+# cost every event in production, so they are filtered by prefilter instead.
+DATASET_COMPONENTS = {
+    "httpd.access": "parse_ecs_socket",
+    "httpd.error": "parse_ecs_socket",
+    "httpd.ecs_log.stats": "parse_ecs_socket",
+    "php-fpm.access": "parse_ecs_php_fpm",
+    "php-fpm.error": "parse_ecs_php_fpm",
+    "php-fpm.www-error": "parse_ecs_php_fpm",
+    "jobber.runs": "parse_ecs_jobber",
+    "supervisor.log": "parse_ecs_supervisor",
+    "system.logs": "parse_ecs_socket",
+    "application.logs": "parse_ecs_socket",
+}
+MODULE_COMPONENTS = {
+    "httpd": "parse_ecs_socket",
+    "php-fpm": "parse_ecs_php_fpm",
+    "jobber": "parse_ecs_jobber",
+    "supervisor": "parse_ecs_supervisor",
+    "system": "parse_ecs_socket",
+    "application": "parse_ecs_socket",
+}
+
+ERROR_DATASETS = ("httpd.error", "php-fpm.error")
+ERROR_LEVELS = ("error", "warn", "warning")
+READ_SIZE = 65536
+FILE_READ_SIZE = 1024 * 1024
+
+# Memory used by aggregates is bounded, paths over limit are counted together
+MAX_PATHS = 10000
+OTHER_PATHS = "(other)"
+# Latency histogram buckets in nanoseconds, ten buckets per decade from 100 µs to 100 s
+LATENCY_BUCKETS = tuple(round(100_000 * 10 ** (i / 10)) for i in range(61))
+# Numeric IDs and UUIDs in URL path, so for example `/events/view/1` and `/events/view/2` are aggregated together
+PATH_ID = re.compile(r"/(?:\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?=/|$)", re.IGNORECASE)
+AGGREGATES = ("top-duration", "latency", "error-rate")
+
 
 class CliColors:
     HEADER = '\033[95m'
@@ -26,86 +69,332 @@ class CliColors:
 
 
 def ecs_is_error(item: dict) -> bool:
-    if item["event"]["dataset"] in ("httpd.error", "php-fpm.error"):
+    if item["event"]["dataset"] in ERROR_DATASETS:
         return True
 
-    if "log" in item and "level" in item["log"] and item["log"]["level"] in ("error", "warn", "warning"):
+    if "log" in item and "level" in item["log"] and item["log"]["level"] in ERROR_LEVELS:
         return True
 
     return False
 
 
-def fetch_items():
-    vector = subprocess.Popen(["/usr/bin/vector", "--color", "always", "tap", "parse_ecs_*"], stdout=subprocess.PIPE)
-    for line in vector.stdout:
-        yield orjson.loads(line)
+def tap_patterns(dataset: Optional[list], module: Optional[list]) -> List[str]:
+    if dataset:
+        return sorted({DATASET_COMPONENTS[name] for name in dataset})
+    if module:
+        return sorted({MODULE_COMPONENTS[name] for name in module})
+    return ["parse_ecs_*"]
 
 
-def main(dataset: Optional[list] = None, module: Optional[list] = None, errors_only: bool = False, as_line: bool = False):
-    for item in fetch_items():
-        if dataset and not item["event"]["dataset"] in dataset:
-            continue
+class Filter:
+    def __init__(self, dataset: Optional[list] = None, module: Optional[list] = None, errors_only: bool = False,
+                 since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                 status: Optional[list] = None, user: Optional[list] = None):
+        self.dataset = dataset
+        self.module = module
+        self.errors_only = errors_only
+        self.since = since
+        self.until = until
+        self.status = status
+        self.user = user
+        self.prefilter = self._create_prefilter()
+
+    def _create_prefilter(self) -> List[Tuple[bytes, ...]]:
+        """
+        Byte patterns that must be in line before line is decoded. Line must contain at least one pattern from every
+        tuple. Prefilter can pass line that doesn't match (for example when pattern is in message), so decoded item
+        must be checked again, but it can never reject line that matches.
+        """
+        prefilter = []
+        if self.dataset:
+            prefilter.append(tuple(b'"dataset":"' + name.encode() + b'"' for name in self.dataset))
+        if self.module:
+            prefilter.append(tuple(b'"module":"' + name.encode() + b'"' for name in self.module))
+        if self.errors_only:
+            prefilter.append(tuple(b'"dataset":"' + name.encode() + b'"' for name in ERROR_DATASETS) +
+                             tuple(b'"level":"' + level.encode() + b'"' for level in ERROR_LEVELS))
+        if self.status:
+            prefilter.append(tuple(b'"status_code":%d' % status for status in self.status))
+        if self.user:
+            prefilter.append(tuple(user.encode() for user in self.user))
+        return prefilter
+
+    def passes_prefilter(self, line: bytes) -> bool:
+        # Skip also tap notifications and empty lines, that are not JSON
+        if not line.startswith(b"{"):
+            return False
+        for patterns in self.prefilter:
+            for pattern in patterns:
+                if pattern in line:
+                    break
+            else:
+                return False
+        return True
+
+    def matches(self, item: dict, is_error: bool) -> bool:
+        if self.dataset and not item["event"]["dataset"] in self.dataset:
+            return False
+
+        if self.module and not item["event"]["module"] in self.module:
+            return False
+
+        if self.errors_only and not is_error:
+            return False
+
+        if self.since or self.until:
+            timestamp = datetime.datetime.fromisoformat(item["@timestamp"])
+            if (self.since and timestamp < self.since) or (self.until and timestamp >= self.until):
+                return False
+
+        if self.status and item.get("http", {}).get("response", {}).get("status_code") not in self.status:
+            return False
+
+        if self.user:
+            user = item.get("user", {})
+            if not any(str(user[field]) in self.user for field in ("id", "email", "name") if field in user):
+                return False
+
+        return True
+
+
+def fetch_chunks(patterns: List[str]) -> Iterator[List[bytes]]:
+    """Yields lines from `vector tap` in chunks as they are read from pipe, so output can be flushed once per chunk"""
+    vector = subprocess.Popen(["/usr/bin/vector", "--color", "always", "tap"] + patterns, stdout=subprocess.PIPE)
+    fd = vector.stdout.fileno()
+    rest = b""
+    while True:
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        yield lines
+
+
+def format_item(item: dict, is_error: bool, as_line: bool) -> bytes:
+    if "original" in item["event"]:
+        del item["event"]["original"]
+
+    # Remove unnecessary metadata
+    del item["ecs"]
+    if "created" in item["event"]:
+        del item["event"]["created"]
+    del item["event"]["kind"]  # `event` all the time
+    del item["event"]["provider"]  # `misp` all the time
+
+    if as_line:
+        formatted = f'{item["@timestamp"]} [{item["event"]["dataset"]}] '
+        if "message" in item:
+            formatted += item["message"]
+        elif "error" in item and "message" in item["error"]:
+            formatted += item["error"]["message"]
+        else:
+            formatted += str(item)
+        formatted = formatted.encode(errors="replace")
+    else:
+        formatted = orjson.dumps(item, option=orjson.OPT_INDENT_2)
+
+    if is_error:
+        return CliColors.WARNING.encode() + formatted + CliColors.ENDC.encode() + b"\n"
+    return formatted + b"\n"
+
+
+def main(item_filter: Filter, as_line: bool = False):
+    output = sys.stdout.buffer
+
+    for lines in fetch_chunks(tap_patterns(item_filter.dataset, item_filter.module)):
+        for line in lines:
+            if not item_filter.passes_prefilter(line):
+                continue
+
+            item = orjson.loads(line)
+            is_error = ecs_is_error(item)
+            if item_filter.matches(item, is_error):
+                output.write(format_item(item, is_error, as_line))
+        output.flush()
+
+
+def read_lines(patterns: List[str]) -> Iterator[bytes]:
+    """Reads lines from files in chunks, so memory usage doesn't depend on file size. Files ending with .gz are decompressed."""
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise FileNotFoundError(f"No file matches `{pattern}`")
+
+        for path in paths:
+            with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as f:
+                rest = b""
+                while data := f.read(FILE_READ_SIZE):
+                    lines = (rest + data).split(b"\n")
+                    rest = lines.pop()
+                    yield from lines
+                yield rest
 
-        if module and not item["event"]["module"] in module:
+
+def normalize_path(path: str) -> str:
+    return PATH_ID.sub("/{id}", path)
+
+
+class PathStats:
+    __slots__ = ("count", "duration", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.max = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, duration: int):
+        self.count += 1
+        self.duration += duration
+        self.max = max(self.max, duration)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def quantile(self, q: float) -> int:
+        """Approximate quantile, upper bound of bucket that contains the quantile"""
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if cumulative >= rank:
+                return min(LATENCY_BUCKETS[i], self.max) if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class Aggregates:
+    def __init__(self):
+        self.paths: Dict[str, PathStats] = {}
+        self.minutes: Dict[str, List[int]] = {}  # minute -> [events, errors]
+
+    def add(self, item: dict, is_error: bool):
+        http = item.get("http", {})
+        status = http.get("response", {}).get("status_code")
+        is_error = is_error or (status is not None and status >= 500)
+
+        minute = item["@timestamp"][0:16]  # timestamps are always in UTC
+        counts = self.minutes.get(minute)
+        if counts is None:
+            counts = self.minutes[minute] = [0, 0]
+        counts[0] += 1
+        if is_error:
+            counts[1] += 1
+
+        duration = item["event"].get("duration")
+        path = item.get("url", {}).get("path")
+        if duration is None or path is None:
+            return
+
+        path = normalize_path(path)
+        stats = self.paths.get(path)
+        if stats is None:
+            if len(self.paths) >= MAX_PATHS:
+                path = OTHER_PATHS
+            stats = self.paths.get(path)
+            if stats is None:
+                stats = self.paths[path] = PathStats()
+        stats.observe(duration)
+
+    def top_duration(self, limit: int) -> List[dict]:
+        paths = sorted(self.paths.items(), key=lambda p: p[1].duration, reverse=True)[0:limit]
+        return [{"path": path, "count": stats.count, "total_ms": stats.duration / 1e6, "avg_ms": stats.duration / stats.count / 1e6}
+                for path, stats in paths]
+
+    def latency(self, limit: int) -> List[dict]:
+        paths = sorted(self.paths.items(), key=lambda p: p[1].count, reverse=True)[0:limit]
+        return [{"path": path, "count": stats.count, "p50_ms": stats.quantile(0.5) / 1e6, "p95_ms": stats.quantile(0.95) / 1e6,
+                 "p99_ms": stats.quantile(0.99) / 1e6, "max_ms": stats.max / 1e6} for path, stats in paths]
+
+    def error_rate(self) -> List[dict]:
+        return [{"minute": minute, "count": events, "errors": errors, "error_rate": errors / events}
+                for minute, (events, errors) in sorted(self.minutes.items())]
+
+
+def print_table(rows: List[dict]):
+    if not rows:
+        print("No matching events")
+        return
+
+    formatted = [[f"{value:.3f}" if type(value) is float else str(value) for value in row.values()] for row in rows]
+    widths = [max(len(name), *(len(row[i]) for row in formatted)) for i, name in enumerate(rows[0])]
+    print("  ".join(name.ljust(width) if i == 0 else name.rjust(width) for i, (name, width) in enumerate(zip(rows[0], widths))))
+    for row in formatted:
+        print("  ".join(value.ljust(width) if i == 0 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths))))
+
+
+def query(files: List[str], item_filter: Filter, as_line: bool = False, aggregate: Optional[str] = None,
+          limit: int = 20, as_json: bool = False):
+    """Query log files in ECS format written by Vector when `ECS_LOG_FILE` is set"""
+    output = sys.stdout.buffer
+    aggregates = Aggregates()
+
+    for line in read_lines(files):
+        if not item_filter.passes_prefilter(line):
             continue
 
+        item = orjson.loads(line)
         is_error = ecs_is_error(item)
-        if errors_only and not is_error:
+        if not item_filter.matches(item, is_error):
             continue
 
-        if "original" in item["event"]:
-            del item["event"]["original"]
-
-        # Remove unnecessary metadata
-        del item["ecs"]
-        if "created" in item["event"]:
-            del item["event"]["created"]
-        del item["event"]["kind"]  # `event` all the time
-        del item["event"]["provider"]  # `misp` all the time
-
-        if as_line:
-            if is_error:
-                sys.stdout.write(CliColors.WARNING)
-
-            sys.stdout.write(item["@timestamp"])
-            sys.stdout.write(f' [{item["event"]["dataset"]}] ')
-            if "original" in item["event"]:
-                sys.stdout.write(item["event"]["original"])
-            elif "message" in item:
-                sys.stdout.write(item["message"])
-            elif "error" in item and "message" in item["error"]:
-                sys.stdout.write(item["error"]["message"])
-            else:
-                print(item, file=sys.stdout, end="")
-
-            if is_error:
-                sys.stdout.write(f"{CliColors.ENDC}\n")
-            else:
-                sys.stdout.write("\n")
+        if aggregate:
+            aggregates.add(item, is_error)
         else:
-            formatted = pformat(item, width=160)
+            output.write(format_item(item, is_error, as_line))
 
-            if is_error:
-                sys.stdout.write(CliColors.WARNING)
-                sys.stdout.write(formatted)
-                sys.stdout.write(f"{CliColors.ENDC}\n")
-            else:
-                sys.stdout.write(formatted)
-                sys.stdout.write("\n")
+    if aggregate == "top-duration":
+        rows = aggregates.top_duration(limit)
+    elif aggregate == "latency":
+        rows = aggregates.latency(limit)
+    elif aggregate == "error-rate":
+        rows = aggregates.error_rate()
+    else:
+        output.flush()
+        return
+
+    if as_json:
+        output.write(orjson.dumps(rows, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    else:
+        print_table(rows)
+
+
+def parse_time(value: str) -> datetime.datetime:
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog="misp_ecs_show",
-        description="Show current logs collected by Vector",
+        description="Show current logs collected by Vector or query log files in ECS format",
     )
     parser.add_argument("--dataset", nargs='+', choices=POSSIBLE_DATASETS)
     parser.add_argument("--module", nargs='+', choices=POSSIBLE_MODULES)
     parser.add_argument("--error", action="store_true", help="Show just errors")
     parser.add_argument("--line", action="store_true", help="Show error log as one line")
+    parser.add_argument("--since", type=parse_time, help="Show just events from this time (ISO 8601 format, UTC if timezone is not provided)")
+    parser.add_argument("--until", type=parse_time, help="Show just events before this time")
+    parser.add_argument("--status", nargs='+', type=int, help="Show just events with given HTTP status code")
+    parser.add_argument("--user", nargs='+', help="Show just events for given user ID or email")
+    parser.add_argument("--file", nargs='+', help="Query given log files (glob patterns are supported) instead of showing current logs")
+    parser.add_argument("--aggregate", choices=AGGREGATES, help="Print aggregated statistics for events from files instead of events")
+    parser.add_argument("--limit", type=int, default=20, help="Number of paths in aggregated statistics")
+    parser.add_argument("--json", action="store_true", help="Print aggregated statistics as JSON")
     parsed = parser.parse_args()
 
+    if parsed.aggregate and not parsed.file:
+        parser.error("--aggregate requires --file")
+
+    item_filter = Filter(parsed.dataset, parsed.module, parsed.error, parsed.since, parsed.until, parsed.status, parsed.user)
+
     try:
-        main(parsed.dataset, parsed.module, parsed.error, parsed.line)
-    except KeyboardInterrupt:
+        if parsed.file:
+            query(parsed.file, item_filter, parsed.line, parsed.aggregate, parsed.limit, parsed.json)
+        else:
+            main(item_filter, parsed.line)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    except (KeyboardInterrupt, BrokenPipeError):
         pass
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Precompress static files by brotli and gzip when image is built and write manifest of created variants, that is used
+# by httpd RewriteMap to serve them directly
+import os
+import sys
+import gzip
+import argparse
+import subprocess
+import concurrent.futures
+from typing import List, Optional, Tuple
+
+MANIFEST = "/usr/local/share/misp-precompressed.txt"
+# Must be kept in sync with `ForceType` rules in misp.conf
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".map", ".json", ".svg", ".txt", ".ttf", ".otf", ".eot", ".ico")
+DEFAULT_MIN_SIZE = 1024  # bytes, smaller files fit to one packet anyway
+
+
+def brotli_compress(path: str) -> bytes:
+    # Python brotli module is not installed, but brotli command is
+    return subprocess.run(["brotli", "-q", "11", "-c", path], stdout=subprocess.PIPE, check=True).stdout
+
+
+def gzip_compress(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return gzip.compress(f.read(), compresslevel=9, mtime=0)  # mtime is set to zero, so output is reproducible
+
+
+COMPRESSORS = (
+    ("br", brotli_compress),
+    ("gz", gzip_compress),
+)
+
+
+def find_files(root: str, min_size: int) -> List[str]:
+    """Returns paths of compressible files, symlinks are skipped, because their target can change in runtime"""
+    output = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS) or any(c.isspace() for c in path) or os.path.islink(path):
+                continue
+            if os.path.getsize(path) >= min_size:
+                output.append(path)
+    return sorted(output)
+
+
+def write_variant(path: str, variant_path: str, content: bytes):
+    """Write compressed variant with the same owner and mode as original file"""
+    stat = os.stat(path)
+    with open(variant_path, "wb") as f:
+        f.write(content)
+    os.chmod(variant_path, stat.st_mode & 0o777)
+    os.chown(variant_path, stat.st_uid, stat.st_gid)
+
+
+def remove_variant(variant_path: str):
+    try:
+        os.remove(variant_path)
+    except FileNotFoundError:
+        pass
+
+
+def precompress(path: str) -> Tuple[int, List[Tuple[str, Optional[int]]]]:
+    """Create compressed variants of given file, just variants smaller than original are kept"""
+    size = os.path.getsize(path)
+    variants = []
+    for extension, compressor in COMPRESSORS:
+        variant_path = f"{path}.{extension}"
+        content = compressor(path)
+        if len(content) < size:
+            write_variant(path, variant_path, content)
+            variants.append((extension, len(content)))
+        else:
+            remove_variant(variant_path)  # remove possible variant from previous run
+            variants.append((extension, None))
+    return size, variants
+
+
+def write_manifest(manifest_path: str, root: str, results: dict):
+    lines = ["# Do not edit this file directly! It is automatically generated by misp_precompress.py.\n",
+             "# Request path and comma separated list of available compressed variants\n"]
+    for path, (_, variants) in sorted(results.items()):
+        extensions = [extension for extension, compressed_size in variants if compressed_size is not None]
+        if extensions:
+            lines.append(f"/{os.path.relpath(path, root)} {','.join(extensions)}\n")
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(lines)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, manifest_path)
+
+
+def print_summary(results: dict):
+    original = sum(size for size, _ in results.values())
+    print(f"Precompressed {len(results)} files with size {original / 1024:.0f} KiB")
+    for extension, _ in COMPRESSORS:
+        count = 0
+        compressed = 0
+        for size, variants in results.values():
+            compressed_size = dict(variants)[extension]
+            if compressed_size is not None:
+                count += 1
+                compressed += compressed_size
+            else:
+                compressed += size
+        print(f"  {extension}: {count} variants created, total size {compressed / 1024:.0f} KiB ({compressed / max(original, 1):.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompress static files by brotli and gzip and write manifest for httpd")
+    parser.add_argument("root", help="Directory to walk, usually MISP webroot")
+    parser.add_argument("--manifest", default=MANIFEST, help="Path to manifest used by httpd RewriteMap")
+    parser.add_argument("--min-size", type=int, default=DEFAULT_MIN_SIZE, help="Files smaller than this size in bytes are not compressed")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    paths = find_files(root, args.min_size)
+
+    # Compression runs in subprocess or in zlib that releases GIL, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = dict(zip(paths, executor.map(precompress, paths)))
+
+    write_manifest(args.manifest, root, results)
+    print_summary(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
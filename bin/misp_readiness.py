@@ -0,0 +1,130 @@
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Shared waiting for backend services with exponential backoff, so many containers started at the same time don't
+# reconnect in lockstep
+import ssl
+import time
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+# Previous fixed waiting tried nine times with one second sleep
+DEFAULT_TIMEOUT = 9.0  # seconds
+INITIAL_DELAY = 0.1
+MAX_DELAY = 5.0
+
+
+def backoff_delay(attempt: int, initial: float = INITIAL_DELAY, maximum: float = MAX_DELAY) -> float:
+    """Exponential backoff with jitter, returned delay is between half and full of exponential delay"""
+    delay = min(maximum, initial * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def close_quietly(result):
+    close = getattr(result, "close", None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception:
+        pass
+
+
+def wait_for(name: str, probe: Callable[[], T], timeout: float = DEFAULT_TIMEOUT) -> T:
+    """
+    Call blocking `probe` function until it returns without exception or until timeout expires. Probe is called
+    directly, so it must use its own socket timeouts shorter than `timeout`. Result of probe that returned after
+    deadline is closed.
+    :raises TimeoutError: when service is not ready before timeout, original exception is set as cause
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            result = probe()
+        except Exception as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"{name} is not ready after {timeout} seconds: {e}") from e
+            delay = min(backoff_delay(attempt), remaining)
+            logging.info(f"Waiting for {name} connection, next try in {delay:.2f} s ({e})")
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        if time.monotonic() > deadline:
+            close_quietly(result)
+            raise TimeoutError(f"{name} is not ready after {timeout} seconds: probe returned after deadline")
+        return result
+
+
+async def wait_for_async(name: str, probe: Callable[[], Awaitable[None]], timeout: float = DEFAULT_TIMEOUT):
+    """
+    Await `probe` coroutine until it returns without exception or until timeout expires. Every attempt is cancelled
+    when deadline is reached, so probe must use just asyncio I/O.
+    :raises TimeoutError: when service is not ready before timeout, original exception is set as cause
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    while True:
+        try:
+            return await asyncio.wait_for(probe(), max(deadline - loop.time(), 0))
+        except Exception as e:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"{name} is not ready after {timeout} seconds: {str(e) or type(e).__name__}") from e
+            delay = min(backoff_delay(attempt), remaining)
+            logging.info(f"Waiting for {name} connection, next try in {delay:.2f} s ({str(e) or type(e).__name__})")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+async def wait_for_all(probes: Dict[str, Callable[[], Awaitable[None]]], timeout: float = DEFAULT_TIMEOUT):
+    """Wait for all services at the same time, returns when all of them are ready"""
+    await asyncio.gather(*(wait_for_async(name, probe, timeout) for name, probe in probes.items()))
+
+
+async def probe_mysql(host: str, port: int):
+    """MySQL server sends handshake packet right after connect, or error packet when it cannot accept connection"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        header = await reader.readexactly(4)
+        payload = await reader.readexactly(int.from_bytes(header[:3], "little"))
+    finally:
+        writer.close()
+
+    if payload[:1] == b"\xff":
+        raise ConnectionError(payload[3:].decode(errors="replace"))
+
+
+async def probe_redis(host: str, port: int, use_tls: bool = False):
+    """Redis server responds to PING also when authentication is required, but not when it is loading data"""
+    context = None
+    if use_tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+    reader, writer = await asyncio.open_connection(host, port, ssl=context)
+    try:
+        writer.write(b"PING\r\n")
+        await writer.drain()
+        response = await reader.readline()
+    finally:
+        writer.close()
+
+    if not response.startswith((b"+", b"-NOAUTH")):
+        raise ConnectionError(response.decode(errors="replace").strip() or "connection closed")
+
+
+def wait_for_backends(mysql_host: str, mysql_port: int, redis_host: str, redis_port: int, redis_use_tls: bool = False,
+                      timeout: float = DEFAULT_TIMEOUT):
+    """
+    Wait until MySQL and Redis servers accept connections, both servers are probed concurrently.
+    :raises TimeoutError: when any server is not ready before timeout
+    """
+    asyncio.run(wait_for_all({
+        f"MySQL server {mysql_host}:{mysql_port}": lambda: probe_mysql(mysql_host, mysql_port),
+        f"Redis server {redis_host}:{redis_port}": lambda: probe_redis(redis_host, redis_port, redis_use_tls),
+    }, timeout))
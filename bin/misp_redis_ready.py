@@ -1,11 +1,27 @@
 #!/usr/bin/env python3.12
 # Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
 import os
+import re
 import sys
+import json
 import time
-from typing import Optional, Tuple
+import argparse
+import statistics
+from typing import Optional, Tuple, Dict
 import redis
 import logging
+import misp_readiness
+
+# Redis databases used by MISP, see Config/config.php and generate_sessions_in_redis_config in misp_create_configs.py
+DATABASES = {
+    10: "zeromq",
+    11: "background_jobs",
+    12: "sessions",
+    13: "misp",
+}
+BACKGROUND_JOBS_DATABASE = 11
+BACKGROUND_JOBS_NAMESPACE = "background_jobs"
+MISP_CONFIG = "/var/www/MISP/app/Config/config.php"
 
 
 def error(message: str):
@@ -23,25 +39,20 @@ def convert_bool(value: str) -> bool:
     error(f"Environment variable 'REDIS_USE_TLS' must be boolean (`true`, `1`, `yes`, `false`, `0` or `no`), `{value}` given")
 
 
-def connect(host: str, port: int, password: Optional[str] = None, use_tls: bool = False) -> redis.Redis:
-    r = redis.Redis(host=host, port=port, password=password, ssl=use_tls)
+def connect(host: str, port: int, password: Optional[str] = None, use_tls: bool = False, db: int = 0) -> redis.Redis:
+    r = redis.Redis(host=host, port=port, password=password, ssl=use_tls, socket_connect_timeout=1, db=db)
     r.ping()
     return r
 
 
 def wait_for_connection(host: str, port: int, password: Optional[str] = None, use_tls: bool = False) -> redis.Redis:
     logging.info(f"Connecting to Redis server {host}:{port}")
-    last_exception = None
-    for i in range(1, 10):
-        try:
-            return connect(host, port, password, use_tls)
-        except Exception as e:
-            last_exception = e
-            logging.info("Waiting for Redis connection...")
-            time.sleep(1)
-    logging.error(f"Could not connect to Redis server {host}:{port}")
-    print(last_exception, file=sys.stderr)
-    sys.exit(1)
+    try:
+        return misp_readiness.wait_for(f"Redis server {host}:{port}", lambda: connect(host, port, password, use_tls))
+    except TimeoutError as e:
+        logging.error(f"Could not connect to Redis server {host}:{port}")
+        print(e.__cause__ or e, file=sys.stderr)
+        sys.exit(1)
 
 
 def wait_for_load(connection: redis.Redis):
@@ -69,6 +80,19 @@ def wait_for_load(connection: redis.Redis):
         logging.warning("Redis is still loading data to memory, waiting skipped")
 
 
+def password_from_config() -> Optional[str]:
+    """
+    Sensitive variables are removed from environment before supervisor is started, so processes started by supervisor
+    must read Redis password from generated MISP config
+    """
+    try:
+        with open(MISP_CONFIG) as f:
+            match = re.search(r"'redis_password' => '((?:[^'\\]|\\.)*)'", f.read())
+    except OSError:
+        return None
+    return match.group(1).replace("\\'", "'") if match else None
+
+
 def get_connection_info() -> Tuple[str, int, Optional[str], bool]:
     host = os.environ.get("REDIS_HOST")
     if host is None:
@@ -76,6 +100,8 @@ def get_connection_info() -> Tuple[str, int, Optional[str], bool]:
         
     port = int(os.environ.get("REDIS_PORT", 6379))
     password = os.environ.get("REDIS_PASSWORD")
+    if password is None:
+        password = password_from_config()
 
     use_tls = os.environ.get("REDIS_USE_TLS")
     use_tls = convert_bool(use_tls) if use_tls else False
@@ -83,10 +109,96 @@ def get_connection_info() -> Tuple[str, int, Optional[str], bool]:
     return host, port, password, use_tls
 
 
+def background_job_queues(connection: redis.Redis) -> Dict[str, int]:
+    """Returns number of jobs waiting in every SimpleBackgroundJobs queue, connection must use background jobs database"""
+    prefix = f"{BACKGROUND_JOBS_NAMESPACE}:queue:"
+    keys = sorted(connection.scan_iter(match=f"{prefix}*", count=1000))
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.llen(key)
+    return {key.decode()[len(prefix):]: length for key, length in zip(keys, pipeline.execute())}
+
+
+def measure_latency(connection: redis.Redis, count: int) -> dict:
+    """Round trip latency of sequential PINGs and average time of one PING when they are pipelined, in milliseconds"""
+    count = max(count, 1)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        connection.ping()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    pipeline = connection.pipeline(transaction=False)
+    for _ in range(count):
+        pipeline.ping()
+    start = time.perf_counter()
+    pipeline.execute()
+    pipelined = (time.perf_counter() - start) * 1000 / count
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if count > 1 else latencies * 99
+    return {
+        "count": count,
+        "p50": round(percentiles[49], 3),
+        "p95": round(percentiles[94], 3),
+        "p99": round(percentiles[98], 3),
+        "max": round(max(latencies), 3),
+        "pipelined_avg": round(pipelined, 3),
+    }
+
+
+def diagnose(host: str, port: int, password: Optional[str], use_tls: bool, pings: int) -> dict:
+    connection = connect(host, port, password, use_tls)
+    info = connection.info()
+
+    databases = {}
+    for db, name in DATABASES.items():
+        keyspace = info.get(f"db{db}", {})
+        databases[name] = {"db": db, "keys": keyspace.get("keys", 0), "expires": keyspace.get("expires", 0)}
+
+    jobs_connection = connect(host, port, password, use_tls, db=BACKGROUND_JOBS_DATABASE)
+    try:
+        queues = background_job_queues(jobs_connection)
+    finally:
+        jobs_connection.close()
+
+    # Some fields may be missing when Redis alternative is used
+    output = {
+        "server": {
+            "version": info.get("redis_version"),
+            "uptime_seconds": info.get("uptime_in_seconds"),
+            "connected_clients": info.get("connected_clients"),
+            "blocked_clients": info.get("blocked_clients"),
+        },
+        "memory": {
+            "used_bytes": info.get("used_memory"),
+            "peak_bytes": info.get("used_memory_peak"),
+            "max_bytes": info.get("maxmemory"),
+            "max_policy": info.get("maxmemory_policy"),
+            "fragmentation_ratio": info.get("mem_fragmentation_ratio"),
+            "evicted_keys": info.get("evicted_keys"),
+        },
+        "databases": databases,
+        "latency_ms": measure_latency(connection, pings),
+        "background_job_queues": queues,
+    }
+    connection.close()
+    return output
+
+
 def main():
     logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.DEBUG)
 
+    parser = argparse.ArgumentParser(description="Wait until Redis is ready or print Redis diagnostic info")
+    parser.add_argument("mode", nargs="?", choices=("wait", "diagnose"), default="wait")
+    parser.add_argument("--pings", type=int, default=100, help="Number of PINGs for latency measurement in diagnose mode")
+    args = parser.parse_args()
+
     host, port, password, use_tls = get_connection_info()
+
+    if args.mode == "diagnose":
+        print(json.dumps(diagnose(host, port, password, use_tls, args.pings), indent=2))
+        return
+
     redis = wait_for_connection(host, port, password, use_tls)
 
     info = redis.info("server")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Runs container startup steps with declared dependencies, so independent steps can run in parallel
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+import concurrent.futures
+from typing import List, Dict, Optional, Callable
+import misp_readiness
+
+MISP_APP = "/var/www/MISP/app"
+CONFIG_FILES = [f"{MISP_APP}/Config/{name}.php" for name in ("config", "database", "email")]
+CAKE = f"{MISP_APP}/Console/cake"
+
+
+class Step:
+    def __init__(self, name: str, commands: List[List[str]], requires: tuple = (), allow_failure: bool = False,
+                 function: Optional[Callable[[], None]] = None):
+        """
+        :param name: Unique step name
+        :param commands: Commands that will be executed one after another
+        :param function: Function executed in startup process before commands, step fails when it raises exception
+        :param requires: Names of steps that must successfully finish before this step is started
+        :param allow_failure: If True, failure of this step doesn't stop startup
+        """
+        self.name = name
+        self.commands = commands
+        self.requires = requires
+        self.allow_failure = allow_failure
+        self.function = function
+        self.status = "pending"
+        self.duration = 0.0
+
+
+def wait_for_backends():
+    use_tls = os.environ.get("REDIS_USE_TLS", "").lower() in ("true", "1", "yes", "on")
+    misp_readiness.wait_for_backends(os.environ.get("MYSQL_HOST", ""), int(os.environ.get("MYSQL_PORT", 3306)),
+                                     os.environ.get("REDIS_HOST", ""), int(os.environ.get("REDIS_PORT", 6379)), use_tls)
+
+
+def startup_steps() -> List[Step]:
+    steps = [
+        Step("configs", [["misp_create_configs.py"]]),
+        # Crypto policy is generated by misp_create_configs.py and must be applied before any connection is made
+        Step("crypto_policies", [["update-crypto-policies"]], requires=("configs",)),
+        Step("config_permissions", [
+            ["mkdir", "-p", "-m", "770", "/tmp/cake/"],  # tmp directory for cake cache
+            ["chown", "apache:apache", "/tmp/cake/"],
+            ["mkdir", "-p", "-m", "750", "/run/misp-status/"],  # socket directory for misp_status.py daemon
+            ["chown", "apache:apache", "/run/misp-status/"],
+            ["chown", "root:apache"] + CONFIG_FILES,  # make config files not readable by others
+            ["chmod", "440"] + CONFIG_FILES,
+        ], requires=("configs",)),
+        # Check syntax errors in generated config files
+        Step("php_lint", [["su-exec", "apache", "php", "-n", "-l", path] for path in CONFIG_FILES], requires=("config_permissions",)),
+        Step("image_symlinks", [["su-exec", "apache", "misp_image_symlinks.py"]]),
+        Step("check_permissions", [["su-exec", "apache", "misp_check_permissions.py"]], requires=("configs",)),
+        Step("httpd_config", [["httpd", "-t"]], requires=("configs",)),
+        Step("php_fpm_config", [["php-fpm", "--test"]], requires=("configs",)),
+        # Wait until MySQL and Redis servers are ready, both are probed at the same time
+        Step("backends", [], function=wait_for_backends, requires=("crypto_policies",)),
+        # Create database schema and check if database is ready
+        Step("database", [["su-exec", "apache", "misp_create_database.py", os.environ.get("MYSQL_HOST", ""),
+                           os.environ.get("MYSQL_LOGIN", ""), os.environ.get("MYSQL_DATABASE", ""), "/var/www/MISP/INSTALL/MYSQL.sql"]],
+             requires=("backends",)),
+        # Check if redis is listening and running
+        Step("redis", [["su-exec", "apache", "misp_redis_ready.py"]], requires=("backends",)),
+        # Update database to latest version, but just when all configs are valid
+        Step("run_updates", [["su-exec", "apache", CAKE, "Admin", "runUpdates"]],
+             requires=("php_lint", "image_symlinks", "check_permissions", "httpd_config", "php_fpm_config", "database", "redis"), allow_failure=True),
+    ]
+
+    if os.environ.get("SECURITY_ENCRYPTION_KEY"):
+        # Checks if encryption key is valid if set, but continue even if not valid
+        steps.append(Step("encryption_key", [["su-exec", "apache", CAKE, "Admin", "isEncryptionKeyValid"]],
+                          requires=("run_updates",), allow_failure=True))
+
+    return steps
+
+
+def validate(steps: List[Step]):
+    names = {step.name for step in steps}
+    for step in steps:
+        for required in step.requires:
+            if required not in names:
+                raise ValueError(f"Step `{step.name}` requires unknown step `{required}`")
+
+    # Check for cycles by removing steps without unresolved requirements
+    remaining = {step.name: set(step.requires) for step in steps}
+    while remaining:
+        ready = [name for name, requires in remaining.items() if not requires]
+        if not ready:
+            raise ValueError(f"Steps {', '.join(sorted(remaining))} contain dependency cycle")
+        for name in ready:
+            del remaining[name]
+        for requires in remaining.values():
+            requires.difference_update(ready)
+
+
+class Runner:
+    def __init__(self, steps: List[Step]):
+        validate(steps)
+        self.steps = {step.name: step for step in steps}
+        self._processes: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+        self._print_lock = threading.Lock()
+        self._stopping = False
+
+    def _print(self, step: Step, line: str):
+        """Print line of step output immediately, so progress of long steps is visible in container log"""
+        with self._print_lock:
+            print(f"[{step.name}] {line.rstrip()}", flush=True)
+
+    def _run_step(self, step: Step) -> bool:
+        start = time.monotonic()
+        try:
+            if step.function:
+                try:
+                    step.function()
+                except Exception as e:
+                    self._print(step, str(e))
+                    return False
+
+            for command in step.commands:
+                with self._lock:
+                    if self._stopping:
+                        return False
+                    # Python scripts would buffer output when it is not written to terminal
+                    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                               env={**os.environ, "PYTHONUNBUFFERED": "1"})
+                    self._processes[step.name] = process
+
+                # Output is read line by line in this thread, that runs just this step
+                with process.stdout:
+                    for line in process.stdout:
+                        self._print(step, line.decode(errors="replace"))
+                process.wait()
+
+                with self._lock:
+                    del self._processes[step.name]
+
+                if process.returncode != 0:
+                    self._print(step, f"Command `{' '.join(command)}` failed with exit code {process.returncode}")
+                    return False
+            return True
+        except OSError as e:
+            self._print(step, f"Could not execute step: {e}")
+            return False
+        finally:
+            step.duration = time.monotonic() - start
+
+    def _stop(self):
+        """Terminate all running steps, used when step fails"""
+        with self._lock:
+            self._stopping = True
+            for process in self._processes.values():
+                process.terminate()
+
+    def _ready_steps(self) -> List[Step]:
+        ready = []
+        for step in self.steps.values():
+            if step.status != "pending":
+                continue
+            if all(self.steps[name].status in ("success", "failed_allowed") for name in step.requires):
+                ready.append(step)
+        return ready
+
+    def run(self) -> bool:
+        failed = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.steps)) as executor:
+            running = {}
+            while True:
+                if failed is None:
+                    for step in self._ready_steps():
+                        step.status = "running"
+                        running[executor.submit(self._run_step, step)] = step
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    if future.result():
+                        step.status = "success"
+                    elif step.allow_failure:
+                        step.status = "failed_allowed"
+                    elif failed is None:
+                        step.status = "failed"
+                        failed = step
+                        # Fail fast, do not wait for other steps
+                        self._stop()
+                    else:
+                        step.status = "cancelled"
+
+        if failed:
+            print(f"ERROR: Startup step `{failed.name}` failed", file=sys.stderr, flush=True)
+        return failed is None
+
+    def report(self, total: float):
+        print(f"{'step':<20} {'status':<16} {'duration':>10}")
+        for step in sorted(self.steps.values(), key=lambda s: s.duration, reverse=True):
+            print(f"{step.name:<20} {step.status:<16} {step.duration:>9.2f}s")
+        print(f"Startup steps finished in {total:.2f}s (sum of step durations {sum(s.duration for s in self.steps.values()):.2f}s)", flush=True)
+
+
+def main(steps: Optional[List[Step]] = None) -> int:
+    runner = Runner(startup_steps() if steps is None else steps)
+
+    # Terminate running steps when container is stopped during startup
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner._stop())
+
+    start = time.monotonic()
+    success = runner.run()
+    runner.report(time.monotonic() - start)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,13 +4,41 @@
 import os
 import sys
 import json
+import time
+import argparse
 import http.client
 import socket
+import socketserver
 import xmlrpc.client
 import logging
+import threading
 import subprocess
+import concurrent.futures
+import http.server
+from typing import Optional, Tuple, List
+import redis
 import requests
 import misp_redis_ready
+import misp_warmup
+
+CHECK_TIMEOUT = 5  # seconds
+STATUS_SOCKET = "/run/misp-status/status.sock"
+METRICS_SOCKET = "/run/misp-status/metrics.sock"
+
+# See https://httpd.apache.org/docs/2.4/mod/mod_status.html
+SCOREBOARD_STATES = {
+    "_": "waiting",
+    "S": "starting",
+    "R": "reading",
+    "W": "sending",
+    "K": "keepalive",
+    "D": "dns",
+    "C": "closing",
+    "L": "logging",
+    "G": "finishing",
+    "I": "idle_cleanup",
+    ".": "open_slot",
+}
 
 
 class UnixStreamHTTPConnection(http.client.HTTPConnection):
@@ -18,6 +46,7 @@ class UnixStreamHTTPConnection(http.client.HTTPConnection):
         self.sock = socket.socket(
             socket.AF_UNIX, socket.SOCK_STREAM
         )
+        self.sock.settimeout(self.timeout)
         self.sock.connect(self.host)
 
 
@@ -27,7 +56,7 @@ class UnixStreamTransport(xmlrpc.client.Transport, object):
         super().__init__()
 
     def make_connection(self, host):
-        return UnixStreamHTTPConnection(self.socket_path)
+        return UnixStreamHTTPConnection(self.socket_path, timeout=CHECK_TIMEOUT)
 
 
 class UnixStreamXMLRPCClient(xmlrpc.client.ServerProxy):
@@ -45,24 +74,55 @@ class SubprocessException(Exception):
         super().__init__(message)
 
 
-s = requests.Session()
-supervisor_api = UnixStreamXMLRPCClient("/run/supervisor/supervisor.sock")
+# Connections are kept between checks, so they can be reused when checks are executed repeatedly. They are created by
+# `init()`, so importing this module has no side effects.
+s: Optional[requests.Session] = None
+supervisor_api: Optional[UnixStreamXMLRPCClient] = None
+redis_connection: Optional[redis.Redis] = None
+executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
 
-def check_supervisor():
-    state = supervisor_api.supervisor.getState()
+def init():
+    global s, supervisor_api, executor
+    s = requests.Session()
+    supervisor_api = UnixStreamXMLRPCClient("/run/supervisor/supervisor.sock")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="check")
+
+
+def exit_now(code: int):
+    """Threads of checks that are still running would block interpreter exit, so process exits without waiting for them"""
+    executor.shutdown(wait=False, cancel_futures=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def fetch_supervisor_state() -> tuple:
+    """Fetch supervisor state and info about all processes in one request"""
+    multicall = xmlrpc.client.MultiCall(supervisor_api)
+    multicall.supervisor.getState()
+    multicall.supervisor.getAllProcessInfo()
+    state, processes_info = multicall()
+
+    processes = {}
+    for process_info in processes_info:
+        processes[process_info["name"]] = process_info
+        processes[f"{process_info['group']}:{process_info['name']}"] = process_info
+    return state, processes
+
+
+def check_supervisor(supervisor: concurrent.futures.Future):
+    state, _ = supervisor.result()
     if state["statecode"] != 1:
         raise Exception(f"Unexpected state code {state['statecode']} received from supervisor, expected 1")
 
 
-def check_supervisor_process(process_name: str) -> bool:
-    try:
-        process_info = supervisor_api.supervisor.getProcessInfo(process_name)
-    except xmlrpc.client.Fault as e:
-        if e.faultCode == 10:  # BAD_NAME
-            return False  # process is not enabled
-        raise
+def check_supervisor_process(supervisor: concurrent.futures.Future, process_name: str) -> bool:
+    _, processes = supervisor.result()
+    if process_name not in processes:
+        return False  # process is not enabled
 
+    process_info = processes[process_name]
     if process_info["state"] != 20:
         raise Exception(f"Invalid process state {process_info['statename']}, expected RUNNING")
 
@@ -70,7 +130,7 @@ def check_supervisor_process(process_name: str) -> bool:
 
 
 def check_fpm_status() -> dict:
-    r = s.get('http://127.0.0.2/fpm-status')
+    r = s.get('http://127.0.0.2/fpm-status', timeout=CHECK_TIMEOUT)
     r.raise_for_status()
 
     output = {}
@@ -81,7 +141,7 @@ def check_fpm_status() -> dict:
 
 
 def check_httpd_status() -> dict:
-    r = s.get('http://127.0.0.2/server-status?auto')
+    r = s.get('http://127.0.0.2/server-status?auto', timeout=CHECK_TIMEOUT)
     r.raise_for_status()
 
     output = {}
@@ -89,16 +149,16 @@ def check_httpd_status() -> dict:
         if ":" in line:
             key, value = line.split(":", 1)
             output[key] = value.strip()
-
-    del output["Scoreboard"]
     return output
 
 
-def check_vector():
-    if not check_supervisor_process("vector"):
+def check_vector(supervisor: concurrent.futures.Future, deadline: float):
+    """Waits for supervisor state and then calls vector API, both must finish before shared deadline"""
+    supervisor.result(timeout=max(deadline - time.monotonic(), 0))
+    if not check_supervisor_process(supervisor, "vector"):
         return False
 
-    r = s.get('http://127.0.0.1:8686/health')
+    r = s.get('http://127.0.0.1:8686/health', timeout=max(deadline - time.monotonic(), 0.1))
     r.raise_for_status()
     if not r.json()["ok"]:
         raise Exception(f"Invalid status ({r.text}) received from vector API")
@@ -106,75 +166,254 @@ def check_vector():
     return True
 
 
-def check_zeromq():
-    return check_supervisor_process("zeromq")
+def check_zeromq(supervisor: concurrent.futures.Future):
+    return check_supervisor_process(supervisor, "zeromq")
 
 
-def check_redis():
-    host, port, password, use_tls = misp_redis_ready.get_connection_info()
-    misp_redis_ready.connect(host, port, password, use_tls)
+def check_warmup(supervisor: concurrent.futures.Future):
+    _, processes = supervisor.result()
+    if "warmup" not in processes:
+        return False  # warm-up is not enabled
 
+    if not os.path.exists(misp_warmup.WARMUP_DONE_FILE):
+        raise Exception("Warm-up requests are not finished yet")
 
-def main() -> dict:
-    output = {
-        "supervisor": False,
-        "httpd": False,
-        "php-fpm": False,
-        "redis": False,
-    }
+    return True
 
-    try:
-        check_supervisor()
-        output["supervisor"] = True
-    except Exception:
-        logging.exception("Could not check supervisor status")
 
+def check_redis():
+    global redis_connection
+    if redis_connection is None:
+        host, port, password, use_tls = misp_redis_ready.get_connection_info()
+        redis_connection = redis.Redis(host=host, port=port, password=password, ssl=use_tls,
+                                       socket_connect_timeout=CHECK_TIMEOUT, socket_timeout=CHECK_TIMEOUT)
     try:
-        check_httpd_status()
-        output["httpd"] = True
+        redis_connection.ping()
     except Exception:
-        logging.exception("Could not check httpd status. Probably Apache is broken.")
+        redis_connection = None  # create new connection for next check
+        raise
 
-    try:
-        check_fpm_status()
-        output["php-fpm"] = True
-    except Exception:
-        logging.exception("Could not check PHP-FPM status. Probably Apache or PHP-FPM is broken.")
 
-    try:
-        check_redis()
-        output["redis"] = True
-    except Exception:
-        logging.exception("Could not check Redis status. Probably Redis connection is broken.")
+# Check name, error message and if check is optional (then check returns False when component is not enabled)
+CHECKS = (
+    ("supervisor", "Could not check supervisor status", False),
+    ("httpd", "Could not check httpd status. Probably Apache is broken.", False),
+    ("php-fpm", "Could not check PHP-FPM status. Probably Apache or PHP-FPM is broken.", False),
+    ("redis", "Could not check Redis status. Probably Redis connection is broken.", False),
+    ("vector", "Could not check vector status", True),
+    ("zeromq", "Could not check zeromq status", True),
+    ("warmup", "Container is not ready, warm-up is still running.", True),
+)
+
+
+def run_checks(timeout: float = CHECK_TIMEOUT) -> Tuple[dict, dict]:
+    """
+    Run all checks in parallel, check that doesn't finish in given timeout is considered as failed. Returns status
+    and values returned by successful checks.
+    """
+    deadline = time.monotonic() + timeout
+    supervisor = executor.submit(fetch_supervisor_state)
+    futures = {
+        "supervisor": executor.submit(check_supervisor, supervisor),
+        "httpd": executor.submit(check_httpd_status),
+        "php-fpm": executor.submit(check_fpm_status),
+        "redis": executor.submit(check_redis),
+        "vector": executor.submit(check_vector, supervisor, deadline),
+        "zeromq": executor.submit(check_zeromq, supervisor),
+        "warmup": executor.submit(check_warmup, supervisor),
+    }
+    concurrent.futures.wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
 
-    try:
-        if check_vector():
-            output["vector"] = True
-    except Exception:
-        output["vector"] = False
-        logging.exception("Could not check vector status")
+    output = {}
+    results = {}
+    for name, error_message, optional in CHECKS:
+        future = futures[name]
+        if not future.done():
+            output[name] = False
+            logging.error(f"{error_message} Check timed out after {timeout} seconds.")
+            continue
+
+        try:
+            results[name] = result = future.result()
+        except Exception:
+            output[name] = False
+            logging.exception(error_message)
+            continue
+
+        if not optional or result:
+            output[name] = True
+
+    return output, results
+
+
+class RateTracker:
+    """Computes per second rate of counters between two calls"""
+
+    def __init__(self):
+        self._previous = {}
+
+    def rate(self, name: str, value: float) -> Optional[float]:
+        now = time.monotonic()
+        previous = self._previous.get(name)
+        self._previous[name] = (now, value)
+        if previous is None or value < previous[1]:  # first value or counter reset by restart
+            return None
+        return (value - previous[1]) / (now - previous[0])
+
+
+def add_metric(lines: List[str], name: str, typ: str, description: str, values: List[Tuple[str, float]]):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {typ}")
+    for labels, value in values:
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+
+def httpd_metrics(lines: List[str], status: dict, rates: Optional[RateTracker]):
+    add_metric(lines, "misp_httpd_workers", "gauge", "Number of httpd workers", [
+        ('state="busy"', int(status["BusyWorkers"])),
+        ('state="idle"', int(status["IdleWorkers"])),
+    ])
+
+    scoreboard = status.get("Scoreboard", "")
+    add_metric(lines, "misp_httpd_scoreboard", "gauge", "Number of httpd worker slots in given state", [
+        (f'state="{state}"', scoreboard.count(char)) for char, state in SCOREBOARD_STATES.items()
+    ])
+
+    if "Total Accesses" in status:  # available just when ExtendedStatus is enabled
+        accesses = int(status["Total Accesses"])
+        add_metric(lines, "misp_httpd_requests_total", "counter", "Number of requests served by httpd", [("", accesses)])
+        add_metric(lines, "misp_httpd_sent_kilobytes_total", "counter", "Number of kilobytes sent by httpd", [("", int(status["Total kBytes"]))])
+        rate = rates.rate("httpd_requests", accesses) if rates else None
+        if rate is not None:
+            add_metric(lines, "misp_httpd_requests_per_second", "gauge", "Rate of requests since previous refresh", [("", round(rate, 3))])
+
+
+def fpm_metrics(lines: List[str], status: dict, rates: Optional[RateTracker]):
+    add_metric(lines, "misp_fpm_processes", "gauge", "Number of PHP-FPM processes", [
+        ('state="active"', int(status["active processes"])),
+        ('state="idle"', int(status["idle processes"])),
+    ])
+    add_metric(lines, "misp_fpm_max_active_processes", "gauge", "Maximum number of active PHP-FPM processes since start", [("", int(status["max active processes"]))])
+    add_metric(lines, "misp_fpm_listen_queue", "gauge", "Number of requests waiting for free PHP-FPM process", [("", int(status["listen queue"]))])
+    add_metric(lines, "misp_fpm_max_listen_queue", "gauge", "Maximum number of requests in listen queue since start", [("", int(status["max listen queue"]))])
+    add_metric(lines, "misp_fpm_listen_queue_length", "gauge", "Size of PHP-FPM socket listen queue", [("", int(status["listen queue len"]))])
+    add_metric(lines, "misp_fpm_max_children_reached_total", "counter", "Number of times PHP-FPM reached max_children limit", [("", int(status["max children reached"]))])
+    add_metric(lines, "misp_fpm_slow_requests_total", "counter", "Number of slow PHP-FPM requests", [("", int(status["slow requests"]))])
+
+    accepted = int(status["accepted conn"])
+    add_metric(lines, "misp_fpm_accepted_connections_total", "counter", "Number of requests accepted by PHP-FPM", [("", accepted)])
+    rate = rates.rate("fpm_accepted", accepted) if rates else None
+    if rate is not None:
+        add_metric(lines, "misp_fpm_requests_per_second", "gauge", "Rate of PHP-FPM requests since previous refresh", [("", round(rate, 3))])
+
+
+def format_metrics(output: dict, results: dict, rates: Optional[RateTracker] = None) -> str:
+    """Returns metrics in Prometheus text exposition format"""
+    lines = []
+    add_metric(lines, "misp_status_check", "gauge", "Result of status check, 1 means OK", [
+        (f'check="{name}"', int(value)) for name, value in output.items()
+    ])
+
+    for name, function in (("httpd", httpd_metrics), ("php-fpm", fpm_metrics)):
+        if name not in results:
+            continue
+        try:
+            function(lines, results[name], rates)
+        except (KeyError, ValueError):
+            logging.exception(f"Could not parse {name} status page")
+
+    return "\n".join(lines) + "\n"
+
+
+def is_healthy(output: dict) -> bool:
+    for value in output.values():
+        if value is False:
+            return False
+    return True
 
-    try:
-        if check_zeromq():
-            output["zeromq"] = True
-    except Exception:
-        output["zeromq"] = False
-        logging.exception("Could not check zeromq status")
 
-    return output
+class SnapshotHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(self.server.snapshot)
 
 
-if __name__ == "__main__":
+class StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Sends the latest status snapshot to every client that connects"""
+    daemon_threads = True
+    snapshot = b""
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.snapshot
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(socket_path: str, handler) -> StatusServer:
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = StatusServer(socket_path, handler)
+    threading.Thread(target=server.serve_forever, name=socket_path, daemon=True).start()
+    return server
+
+
+def run_daemon(socket_path: str, metrics_socket_path: str, interval: float):
+    """
+    Refresh status in given interval and serve it over unix socket for misp_status_client.py. Metrics are served in
+    Prometheus format over HTTP on another unix socket, so they can be fetched by `curl --unix-socket`.
+    """
+    server = start_server(socket_path, SnapshotHandler)
+    metrics_server = start_server(metrics_socket_path, MetricsHandler)
+    logging.info(f"Serving status snapshot on {socket_path} and metrics on {metrics_socket_path}, refreshed every {interval} seconds")
+
+    rates = RateTracker()
+    while True:
+        start = time.monotonic()
+        output, results = run_checks()
+        server.snapshot = json.dumps({"time": time.time(), "interval": interval, "status": output}, separators=(",", ":")).encode()
+        metrics_server.snapshot = format_metrics(output, results, rates).encode()
+        time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+def main():
     if os.geteuid() == 0:
         print("This script should not be run under root user", file=sys.stderr)
         sys.exit(255)
 
-    output = main()
+    parser = argparse.ArgumentParser(description="Checks if all components running properly")
+    parser.add_argument("mode", nargs="?", choices=("check", "daemon", "metrics"), default="check")
+    parser.add_argument("--socket", default=STATUS_SOCKET, help="Unix socket path for serving status in daemon mode")
+    parser.add_argument("--metrics-socket", default=METRICS_SOCKET, help="Unix socket path for serving metrics in daemon mode")
+    parser.add_argument("--interval", type=float, default=10, help="Status refresh interval in seconds in daemon mode")
+    args = parser.parse_args()
+
+    init()
+
+    if args.mode == "daemon":
+        logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO)
+        run_daemon(args.socket, args.metrics_socket, args.interval)
+
+    if args.mode == "metrics":
+        output, results = run_checks()
+        sys.stdout.write(format_metrics(output, results))
+        exit_now(0)
+
+    output, _ = run_checks()
     sys.stdout.write(json.dumps(output, separators=(",", ":")))
+    exit_now(0 if is_healthy(output) else 1)
 
-    for value in output.values():
-        if value is False:
-            sys.exit(1)
 
-    sys.exit(0)
+if __name__ == "__main__":
+    main()
 
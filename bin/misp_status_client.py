@@ -0,0 +1,44 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Fast healthcheck that just reads status snapshot from `misp_status.py daemon`. When daemon is not running or snapshot
+# is too old, checks are executed by misp_status.py directly.
+import os
+import sys
+import json
+import time
+import socket
+from typing import Optional
+
+STATUS_SOCKET = "/run/misp-status/status.sock"
+
+
+def read_snapshot(socket_path: str) -> Optional[dict]:
+    data = b""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(socket_path)
+            while chunk := sock.recv(65536):
+                data += chunk
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    snapshot = read_snapshot(STATUS_SOCKET)
+
+    # Snapshot is considered as stale if daemon missed three refreshes
+    if snapshot is None or time.time() - snapshot["time"] > snapshot["interval"] * 3:
+        os.execvp("misp_status.py", ["misp_status.py"])
+
+    status = snapshot["status"]
+    sys.stdout.write(json.dumps(status, separators=(",", ":")))
+    for value in status.values():
+        if value is False:
+            sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
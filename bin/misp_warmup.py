@@ -0,0 +1,89 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Sends warm-up requests to MISP after container start, so OPcache and CakePHP caches are filled before healthcheck
+# reports container as ready. Requests are not authenticated, so pages that require login just load the application,
+# controller and its models and then redirect to login page.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import concurrent.futures
+from typing import List
+import requests
+import misp_readiness
+
+BASE_URL = "http://127.0.0.2"
+# When this file exists, warm-up is finished, checked by misp_status.py
+WARMUP_DONE_FILE = "/run/misp-status/warmup-done"
+
+
+def wait_for_server(session: requests.Session, timeout: float):
+    """Wait until httpd and PHP-FPM are started by supervisor"""
+    def probe():
+        r = session.get(f"{BASE_URL}/fpm-status", timeout=5)
+        r.raise_for_status()
+
+    misp_readiness.wait_for("httpd and PHP-FPM", probe, timeout)
+
+
+def warmup_request(session: requests.Session, path: str, timeout: float) -> dict:
+    start = time.monotonic()
+    try:
+        # Redirects are not followed, login redirect is enough to load the application
+        r = session.get(f"{BASE_URL}{path}", timeout=timeout, allow_redirects=False)
+    except requests.RequestException as e:
+        logging.warning(f"Warm-up request to {path} failed: {e}")
+        return {"path": path, "status": None, "duration": round(time.monotonic() - start, 3)}
+
+    duration = round(time.monotonic() - start, 3)
+    if r.status_code >= 500:
+        logging.warning(f"Warm-up request to {path} returned status code {r.status_code}")
+    else:
+        logging.info(f"Warm-up request to {path} returned status code {r.status_code} in {duration} s")
+    return {"path": path, "status": r.status_code, "duration": duration}
+
+
+def warmup(paths: List[str], concurrency: int, timeout: float) -> List[dict]:
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda path: warmup_request(session, path, timeout), paths))
+
+
+def write_done_file(results: List[dict], duration: float):
+    tmp_path = f"{WARMUP_DONE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"time": time.time(), "duration": round(duration, 3), "requests": results}, f)
+    os.replace(tmp_path, WARMUP_DONE_FILE)
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Send warm-up requests to MISP through local virtual host")
+    parser.add_argument("--url", action="append", default=[], help="Path to request, for example `/users/login`")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of requests sent at the same time")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout of one warm-up request in seconds")
+    parser.add_argument("--wait-timeout", type=float, default=120, help="Maximum time to wait for httpd and PHP-FPM in seconds")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    results = []
+    try:
+        wait_for_server(requests.Session(), args.wait_timeout)
+        results = warmup(args.url, max(args.concurrency, 1), args.timeout)
+    except TimeoutError as e:
+        logging.error(f"Warm-up skipped: {e}")
+    except Exception:
+        logging.exception("Warm-up failed")
+    finally:
+        # Warm-up is just optimisation, so container is marked as ready even if warm-up failed, otherwise healthcheck
+        # would report container as unhealthy forever
+        write_done_file(results, time.monotonic() - start)
+    logging.info(f"Warm-up finished in {time.monotonic() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
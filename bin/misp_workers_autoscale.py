@@ -0,0 +1,155 @@
+#!/usr/bin/env python3.12
+# Copyright (C) 2024 National Cyber and Information Security Agency of the Czech Republic
+# Starts and stops MISP background workers managed by supervisor according to number of jobs waiting in Redis queues
+import sys
+import time
+import logging
+import argparse
+import xmlrpc.client
+from typing import Optional, List, Dict
+import misp_redis_ready
+from misp_status import UnixStreamXMLRPCClient
+
+SUPERVISOR_SOCKET = "/run/supervisor/supervisor.sock"
+SUPERVISOR_GROUP = "misp-workers"
+SCALE_UP_COOLDOWN = 30  # seconds, new workers need some time to start and fetch jobs
+
+# See http://supervisord.org/subprocess.html#process-states
+ACTIVE_STATES = ("STARTING", "RUNNING", "BACKOFF")
+STARTABLE_STATES = ("STOPPED", "EXITED", "FATAL")
+
+
+class Queue:
+    def __init__(self, name: str, minimum: int, maximum: int, cooldown: float):
+        """
+        :param name: Queue name, supervisor program with the same name must process jobs from this queue
+        :param minimum: Number of workers that are always running
+        :param maximum: Maximum number of workers, supervisor program must have at least this number of processes
+        :param cooldown: Queue must be empty for this time before one worker is stopped
+        """
+        if minimum > maximum:
+            raise ValueError(f"Queue `{name}` minimum workers {minimum} is bigger than maximum {maximum}")
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cooldown = cooldown
+        self.last_scale_up = float("-inf")
+        self.last_scale_down = float("-inf")
+        self.idle_since: Optional[float] = None
+
+    @classmethod
+    def parse(cls, value: str, cooldown: float) -> "Queue":
+        """Parse queue in format `name:min:max`"""
+        try:
+            name, minimum, maximum = value.split(":")
+            return cls(name, int(minimum), int(maximum), cooldown)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"Invalid queue `{value}`, expected format `name:min:max` ({e})")
+
+    def desired(self, running: int, waiting: int, now: float) -> int:
+        """Returns desired number of workers for current number of running workers and jobs waiting in queue"""
+        # Bounds are enforced immediately, cooldowns apply just to scaling according to queue
+        running_bounded = max(self.minimum, min(self.maximum, running))
+        if waiting > 0:
+            self.idle_since = None
+            if running_bounded < self.maximum and now - self.last_scale_up >= SCALE_UP_COOLDOWN:
+                self.last_scale_up = now
+                return min(self.maximum, running_bounded + waiting)
+        else:
+            if self.idle_since is None:
+                self.idle_since = now
+            if running_bounded > self.minimum and now - self.idle_since >= self.cooldown and now - self.last_scale_down >= self.cooldown:
+                self.last_scale_down = now
+                return running_bounded - 1
+        return running_bounded
+
+
+class Autoscaler:
+    def __init__(self, queues: List[Queue], supervisor_socket: str = SUPERVISOR_SOCKET):
+        self.queues = queues
+        self.supervisor_api = UnixStreamXMLRPCClient(supervisor_socket)
+        self.redis = None
+
+    def _queue_depths(self) -> Dict[str, int]:
+        if self.redis is None:
+            host, port, password, use_tls = misp_redis_ready.get_connection_info()
+            self.redis = misp_redis_ready.connect(host, port, password, use_tls, db=misp_redis_ready.BACKGROUND_JOBS_DATABASE)
+        try:
+            return misp_redis_ready.background_job_queues(self.redis)
+        except Exception:
+            self.redis = None  # reconnect in next iteration
+            raise
+
+    def _processes(self) -> Dict[str, List[dict]]:
+        """Returns worker processes for every queue, sorted by process number"""
+        processes = {queue.name: [] for queue in self.queues}
+        for process_info in self.supervisor_api.supervisor.getAllProcessInfo():
+            if process_info["group"] != SUPERVISOR_GROUP:
+                continue
+            program = process_info["name"].rsplit("_", 1)[0]
+            if program in processes:
+                processes[program].append(process_info)
+        for program_processes in processes.values():
+            program_processes.sort(key=lambda p: p["name"])
+        return processes
+
+    def _change(self, method: str, process_info: dict):
+        name = f"{SUPERVISOR_GROUP}:{process_info['name']}"
+        try:
+            getattr(self.supervisor_api.supervisor, method)(name, False)
+        except xmlrpc.client.Fault as e:
+            logging.warning(f"Could not {method} {name}: {e.faultString}")
+
+    def scale(self, queue: Queue, processes: List[dict], target: int):
+        active = [p for p in processes if p["statename"] in ACTIVE_STATES]
+        if target > len(active):
+            for process_info in [p for p in processes if p["statename"] in STARTABLE_STATES][:target - len(active)]:
+                self._change("startProcess", process_info)
+        elif target < len(active):
+            # Stop processes with highest number first, so lowest numbers are always running
+            for process_info in active[target - len(active):]:
+                self._change("stopProcess", process_info)
+
+    def step(self, now: float):
+        depths = self._queue_depths()
+        processes = self._processes()
+        for queue in self.queues:
+            running = sum(1 for p in processes[queue.name] if p["statename"] in ACTIVE_STATES)
+            waiting = depths.get(queue.name, 0)
+            target = queue.desired(running, waiting, now)
+            if target != running:
+                logging.info(f"Scaling `{queue.name}` workers from {running} to {target}, {waiting} jobs waiting")
+                self.scale(queue, processes[queue.name], target)
+
+    def run(self, interval: float):
+        while True:
+            try:
+                self.step(time.monotonic())
+            except Exception as e:
+                logging.error(f"Could not scale workers: {e}")
+            time.sleep(interval)
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Start and stop MISP workers according to number of jobs waiting in queues")
+    parser.add_argument("--queue", action="append", default=[], help="Queue to scale in format `name:min:max`")
+    parser.add_argument("--cooldown", type=float, default=300, help="Time in seconds the queue must be empty before one worker is stopped")
+    parser.add_argument("--interval", type=float, default=10, help="Time in seconds between queue checks")
+    parser.add_argument("--supervisor-socket", default=SUPERVISOR_SOCKET)
+    args = parser.parse_args()
+
+    try:
+        queues = [Queue.parse(value, args.cooldown) for value in args.queue]
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if not queues:
+        parser.error("at least one queue must be provided")
+
+    Autoscaler(queues, args.supervisor_socket).run(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())